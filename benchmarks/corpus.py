@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Deterministic synthetic corpus of blog posts for the benchmarks.
+
+The posts are written as a Bashblog directory of Markdown files, which is
+what `challi import` reads. The same arguments always give the same files,
+modification times (the publish dates) included."""
+
+import os
+import random
+from datetime import datetime, timezone
+
+import click
+
+words = """lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod
+tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam quis
+nostrud exercitation ullamco laboris nisi aliquip ex ea commodo consequat duis
+aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur
+excepteur sint occaecat cupidatat non proident sunt culpa qui officia deserunt
+mollit anim id est laborum blog python sqlite static page archive feed index
+kesä talvi järvi metsä sää yö päivä kirja ääni käsi""".split()
+"""Vocabulary of the posts, with some non-ASCII words."""
+
+start = int(datetime(2005, 1, 1, tzinfo=timezone.utc).timestamp())
+"""Publish date of the first post."""
+
+span = 20 * 365 * 24 * 3600
+"""The posts are spread evenly over this many seconds."""
+
+
+def sentence(rnd: random.Random, n: int) -> str:
+    return " ".join(rnd.choice(words) for i in range(n)).capitalize() + "."
+
+
+def paragraph(rnd: random.Random) -> str:
+    """Make a paragraph, or another Markdown block now and then."""
+
+    kind = rnd.random()
+    if kind < 0.1:
+        return "## " + sentence(rnd, rnd.randint(2, 6))[:-1]
+    if kind < 0.2:
+        return "\n".join("* " + sentence(rnd, rnd.randint(3, 8))
+                         for i in range(rnd.randint(2, 6)))
+    if kind < 0.25:
+        return "\n".join("    " + " = ".join(rnd.sample(words, 2))
+                         for i in range(rnd.randint(2, 8)))
+    if kind < 0.3:
+        return "> " + sentence(rnd, rnd.randint(8, 30))
+    text = []
+    for i in range(rnd.randint(2, 8)):
+        s = sentence(rnd, rnd.randint(5, 20))
+        if rnd.random() < 0.2:
+            s = s[:-1] + " *" + rnd.choice(words) + "*."
+        if rnd.random() < 0.1:
+            s += " [{0}](http://www.example.com/{0}.html)".format(rnd.choice(words))
+        text.append(s)
+    return " ".join(text)
+
+
+def posts(count: int, seed: int = 0, tags: int = 200, tag_skew: float = 1.0,
+          tags_per_post: tuple = (1, 5), paragraphs: tuple = (2, 12),
+          break_ratio: float = 0.6):
+    """Generate posts as (number, publish timestamp, text) tuples.
+
+    Tags are drawn from tags different ones with a Zipf-like distribution,
+    the weight of the nth most common tag being 1 / n ** tag_skew. A share
+    break_ratio of the posts have a summary break (a line matching challi's
+    break_re) after their first paragraphs."""
+
+    rnd = random.Random(seed)
+    tagnames = ["tag{}".format(i) for i in range(1, tags + 1)]
+    weights = [1 / i ** tag_skew for i in range(1, tags + 1)]
+    for number in range(1, count + 1):
+        title = "Post {} {}".format(number, sentence(rnd, rnd.randint(1, 5))[:-1])
+        body = [paragraph(rnd) for i in range(rnd.randint(*paragraphs))]
+        if rnd.random() < break_ratio:
+            body.insert(rnd.randint(1, 2), rnd.choice(("* * *", "---", "___", "- - -")))
+        k = min(rnd.randint(*tags_per_post), tags)
+        post_tags = set()
+        while len(post_tags) < k:
+            post_tags.update(rnd.choices(tagnames, weights, k=k - len(post_tags)))
+        text = "{}\n\n{}\n\nTags: {}\n".format(title, "\n\n".join(body),
+                                              ", ".join(sorted(post_tags)))
+        yield number, start + span * (number - 1) // max(count - 1, 1), text
+
+
+def writecorpus(directory: str, count: int, **options):
+    """Write the posts into directory as post-NNNNNN.md files."""
+
+    os.makedirs(directory, exist_ok=True)
+    for number, timestamp, text in posts(count, **options):
+        filename = os.path.join(directory, "post-{:06d}.md".format(number))
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.utime(filename, (timestamp, timestamp))
+
+
+@click.command()
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.argument("count", type=click.IntRange(min=1))
+@click.option("--seed", type=click.INT, default=0, help="Random seed (default=0).")
+@click.option("--tags", type=click.IntRange(min=1), default=200,
+              help="Number of different tags (default=200).")
+@click.option("--tag-skew", type=click.FloatRange(min=0), default=1.0,
+              help="Zipf exponent of the tag distribution, 0 for uniform (default=1.0).")
+@click.option("--tags-per-post", type=click.IntRange(min=0), nargs=2, default=(1, 5),
+              help="Least and most tags per post (default=1 5).")
+@click.option("--break-ratio", type=click.FloatRange(0, 1), default=0.6,
+              help="Share of posts with a summary break (default=0.6).")
+def main(directory, count, **options):
+    """Write COUNT synthetic posts into DIRECTORY."""
+    writecorpus(directory, count, **options)
+
+
+if __name__ == '__main__':
+    main()
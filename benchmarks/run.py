@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""Benchmarks of the build pipeline on synthetic corpora.
+
+For each corpus size the posts from corpus.py are imported into a new
+blog, then rendering, each page generator, a full rebuild, a rebuild with
+nothing to do, a rebuild after editing one post and db_tagpost() are timed
+separately. Everything runs in this process on
+challi's own functions. The startup time of the
+command line tool is timed in subprocesses, on the same blogs. The results
+are written as JSON so that runs on different commits can be compared with
+--compare."""
+
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+
+import click
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import challi  # noqa: E402
+from corpus import writecorpus  # noqa: E402
+
+startup_commands = {"startup_help": ["--help"],
+                    "startup_ls_help": ["ls", "--help"],
+                    "startup_ls": ["ls"]}
+"""Commands whose startup is timed, by benchmark name."""
+
+generators = ["writeposts", "makeindex", "makefullidx", "maketagpages",
+              "maketagindex", "makefeeds"]
+"""Page generators timed one by one, in this order."""
+
+
+@contextmanager
+def timed(results: dict, name: str):
+    """Time the block: results[name] gets its wall and CPU seconds."""
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    yield
+    results[name] = {"wall": round(time.perf_counter() - wall, 4),
+                     "cpu": round(time.process_time() - cpu, 4)}
+
+
+def challi_cli(*args):
+    """Run a challi command in this process, its output discarded."""
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        challi.cli.main(list(args), prog_name="challi", standalone_mode=False)
+
+
+def coldcache():
+    """Empty the render cache, in memory and in the database, so that the
+    next build renders every post."""
+
+    challi.render_cache = {}
+    challi.new_renders = []
+    challi.conn.execute("DELETE FROM render_cache")
+    challi.conn.commit()
+
+
+def startup(results: dict, runs: int):
+    """Time each of the startup commands as the best of runs runs of
+    challi in a new process, in the current directory."""
+
+    import resource
+
+    script = os.path.join(os.path.dirname(here), "challi.py")
+    for name, args in startup_commands.items():
+        best = None
+        for i in range(runs):
+            cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+            wall = time.perf_counter()
+            subprocess.run([sys.executable, script] + args, check=True,
+                           stdout=subprocess.DEVNULL)
+            wall = time.perf_counter() - wall
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = after.ru_utime + after.ru_stime - cpu.ru_utime - cpu.ru_stime
+            if best is None or wall < best["wall"]:
+                best = {"wall": round(wall, 4), "cpu": round(cpu, 4)}
+        results[name] = best
+
+
+def bench(size: int, workdir: str, retags: int, runs: int, **options) -> dict:
+    """Run the benchmarks on a corpus of size posts. Returns the results by
+    benchmark name."""
+
+    results = {}
+    corpus = os.path.join(workdir, "corpus")
+    blog = os.path.join(workdir, "blog")
+    with timed(results, "corpus"):
+        writecorpus(corpus, size, **options)
+    # challi reads config.ini and challi.db from the working directory
+    os.makedirs(blog)
+    os.chdir(blog)
+    challi_cli("init")
+    # Start from a clean slate: challi keeps the state of a run in globals
+    challi.render_cache = {}
+    challi.new_renders = []
+    challi.output = None
+
+    with timed(results, "import"):
+        challi_cli("import", "--no-rebuild", corpus)
+    startup(results, runs)
+
+    # Rendering on its own, as the first step of a full build: every post
+    # is rendered into an empty render cache, which is then saved
+    challi.output = challi.Output(challi.blog_conf["files"]["blog_dir"])
+    challi.full_build = True
+    challi.loadtemplates()
+    challi.loadmanifest()
+    coldcache()
+    with timed(results, "render"):
+        for post in challi.renderposts(challi.scanposts()):
+            pass
+        challi.saverendercache()
+
+    # Each generator on its own, as a full build from the warm render cache,
+    # so that the timings are of the generators and not of rendering
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for name in generators:
+            with timed(results, name):
+                getattr(challi, name)()
+
+    with timed(results, "rebuild_full"):
+        challi_cli("rebuild", "--full")
+    with timed(results, "rebuild_noop"):
+        challi_cli("rebuild")
+    # Edit the newest post, as after `challi edit`
+    challi.conn.execute("UPDATE posts SET content = content || ? WHERE post_id = "
+                        "(SELECT post_id FROM posts ORDER BY publish_date DESC, post_id DESC "
+                        "LIMIT 1)", ("\n\nEdited.",))
+    challi.conn.commit()
+    with timed(results, "rebuild_edit"):
+        challi_cli("rebuild")
+
+    # Retag posts: every post gets one tag changed
+    conn = challi.conn
+    rows = conn.execute("SELECT post_id FROM posts ORDER BY post_id LIMIT ?",
+                        (retags,)).fetchall()
+    with timed(results, "db_tagpost"):
+        for (post_id,) in rows:
+            tags = [r[0] for r in conn.execute(
+                "SELECT text FROM tags, tags_ref WHERE tags.tag_id = tags_ref.tag_id "
+                "AND tags_ref.post_id = ? ORDER BY tag_ref_id", (post_id,))]
+            challi.db_tagpost(tags[1:] + ["retag{}".format(post_id % 50)], post_id)
+    results["db_tagpost"]["calls"] = len(rows)
+
+    results["posts"] = size
+    results["db_bytes"] = os.path.getsize(challi.db_file)
+    conn.close()
+    challi.conn = None
+    return results
+
+
+def environment() -> dict:
+    """Describe what the benchmarks ran on."""
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=here,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()}
+
+
+def compare(old: dict, new: dict):
+    """Print the wall times of two result files side by side."""
+
+    click.echo("{:>8} {:<14} {:>10} {:>10} {:>8}".format(
+        "posts", "benchmark", "old", "new", "change"))
+    for size, results in new["results"].items():
+        before = old["results"].get(size, {})
+        for name, r in results.items():
+            if not isinstance(r, dict) or name not in before:
+                continue
+            a, b = before[name]["wall"], r["wall"]
+            click.echo("{:>8} {:<14} {:>10.3f} {:>10.3f} {:>+7.1f}%".format(
+                size, name, a, b, (b - a) / a * 100 if a else 0))
+
+
+@click.command()
+@click.option("--sizes", default="100,10000,100000",
+              help="Comma-separated corpus sizes (default=100,10000,100000).")
+@click.option("--output", "-o", type=click.Path(dir_okay=False), default="bench.json",
+              help="Where to write the results (default=bench.json).")
+@click.option("--retags", type=click.IntRange(min=0), default=1000,
+              help="Number of posts to retag with db_tagpost (default=1000).")
+@click.option("--seed", type=click.INT, default=0, help="Corpus random seed (default=0).")
+@click.option("--tags", type=click.IntRange(min=1), default=200,
+              help="Number of different tags (default=200).")
+@click.option("--tag-skew", type=click.FloatRange(min=0), default=1.0,
+              help="Zipf exponent of the tag distribution (default=1.0).")
+@click.option("--startup-runs", type=click.IntRange(min=1), default=5,
+              help="Time the startup of each command as the best of this many runs "
+                   "(default=5).")
+@click.option("--keep", is_flag=True, help="Keep the generated blogs.")
+@click.option("--compare", "compare_to", type=click.File("r"),
+              help="Compare the results with an earlier result file.")
+def main(sizes, output, retags, startup_runs, keep, compare_to, **options):
+    """Benchmark challi on synthetic corpora of the given sizes."""
+
+    cwd = os.getcwd()
+    output = os.path.abspath(output)
+    report = {"environment": environment(),
+              "options": dict(options, retags=retags, startup_runs=startup_runs),
+              "results": {}}
+    for size in (int(s) for s in sizes.split(",")):
+        workdir = tempfile.mkdtemp(prefix="challi-bench-{}-".format(size))
+        click.echo("Benchmarking {} posts in {}".format(size, workdir), err=True)
+        try:
+            report["results"][str(size)] = bench(size, workdir, retags, startup_runs,
+                                                 **options)
+        finally:
+            os.chdir(cwd)
+            if not keep:
+                shutil.rmtree(workdir)
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    click.echo("Results written to {}".format(output), err=True)
+    if compare_to:
+        compare(json.load(compare_to), report)
+
+
+if __name__ == '__main__':
+    main()
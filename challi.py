@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 
 import configparser
+import hashlib
 import locale
 import re
 import sqlite3
-from os import makedirs, path, system
+from os import makedirs, path
 
 from datetime import datetime, timezone
+from collections import namedtuple
+from contextlib import contextmanager, redirect_stdout
+from functools import wraps
+from itertools import groupby, islice
+from time import perf_counter, process_time, time
 from typing import Tuple
-from markdown import markdown
 import click
 
 db_file = "challi.db"
@@ -16,6 +21,15 @@ db_file = "challi.db"
 
 break_re = r'^[*\-_]( *[*\-_]){2,}$'
 """Regular expression used to determine summary breaks in Markdown."""
+break_line = re.compile(break_re, re.MULTILINE)
+"""break_re compiled to find the first break line in a post's content."""
+word_re = re.compile(r"\w+(?:['’]\w+)*")
+"""Regular expression of the words counted in a post."""
+words_per_minute = 200
+"""Reading speed the reading time of a post is estimated with."""
+
+md_extensions = []
+"""Markdown extensions used when rendering posts."""
 
 config_file = "config.ini"
 blog_conf = None
@@ -23,6 +37,52 @@ cur = None
 conn = None
 index_len = None
 header, footer = "", ""
+manifest = {}
+"""Input digest of each generated file as of the previous build, keyed by
+path relative to blog_dir."""
+built = {}
+"""Input digest of each file generated (or found up to date) in this build."""
+base_digest = ""
+"""Digest of the inputs shared by every page in this build."""
+full_build = False
+render_cache = {}
+"""Rendered post content by render key, for this run."""
+new_renders = []
+"""Render cache entries to be stored in the database after the build."""
+regenerated = set()
+"""Paths of the files regenerated in this build."""
+output = None
+"""Output writer for generated files."""
+sql_count = 0
+"""Number of SQL statements run."""
+sql_time = 0.0
+"""Seconds spent running SQL statements and fetching their rows."""
+render_counts = {"rendered": 0, "memory_hits": 0, "db_hits": 0, "misses": 0}
+"""Markdown renders and render cache lookups."""
+stats = None
+"""Stats of the stages of this build, if asked for."""
+templates = {}
+"""Page templates by name, compiled by compiletemplates()."""
+only = None
+"""Path of the only file to make, when pages are made on demand by serve."""
+index_keys = {}
+"""(publish_date, post_id) of the newest post of each index page, by page
+number, as far as known. Lets serve read just the posts of the page asked for."""
+loaded = set()
+"""Parts of the program state set up for this invocation by uses()."""
+page_config = (("blog", None), ("author", None), ("template", None),
+               ("files", ("index_file", "number_of_index_articles", "archive_index",
+                          "tags_index", "blog_feed", "atom_feed",
+                          "number_of_feed_articles", "tag_feeds", "search_index",
+                          "header_file", "footer_file", "body_begin_file",
+                          "css_include")))
+"""The config the generated pages depend on: each section with all of its
+keys (None) or just the keys listed."""
+render_batch = 1000
+"""Number of posts read ahead of the page generators to render the ones
+not in the render cache together."""
+compressible = (".html", ".css", ".rss", ".atom", ".xml", ".js", ".json")
+"""Extensions of the generated files that get precompressed siblings."""
 
 def makeheader() -> str:
     h1 = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
@@ -34,6 +94,10 @@ def makeheader() -> str:
         h1 += "<link rel=\"stylesheet\" href=\"{}\" type=\"text/css\" />".\
             format(css.strip())
 
+    for feed, feedtype in feedfiles():
+        h1 += "<link rel=\"alternate\" type=\"{}\" href=\"{{url}}/{}\" />".\
+            format(feedtype, feed)
+
     h2 = """<title>{title}</title>
     </head><body>
     <div id="divbodyholder">
@@ -48,9 +112,13 @@ def makeheader() -> str:
 
 
 def makefooter() -> str:
+    search = ""
+    if searchdir():
+        search = """ &mdash;
+    <a href="/{}/index.html">{{search}}</a>""".format(searchdir())
     f = """<div id="all_posts">
     <a href="/all_posts.html">{all_posts}</a> &mdash;
-    <a href="/all_tags.html">{all_tags}</a>
+    <a href="/all_tags.html">{all_tags}</a>""" + search + """
     </div>
     <div id="footer">&copy; <a href="{author_url}">{author_name}</a> &mdash;
     <a href="mailto:{author_email}">{author_email}</a><br/>
@@ -60,6 +128,26 @@ def makefooter() -> str:
     return f
 
 
+def feedfiles() -> list:
+    """Get the file names and MIME types of the blog's RSS and Atom feeds."""
+
+    feeds = []
+    rss = blog_conf.get("files", "blog_feed", fallback="feed.rss")
+    if rss:
+        feeds.append((rss, "application/rss+xml"))
+    atom = blog_conf.get("files", "atom_feed", fallback="feed.atom")
+    if atom:
+        feeds.append((atom, "application/atom+xml"))
+    return feeds
+
+
+def searchdir() -> str:
+    """Get the directory of the static search index, relative to blog_dir.
+    It is empty if the search index is not generated."""
+
+    return blog_conf.get("files", "search_index", fallback="search").strip("/")
+
+
 def geturi(filename: str, pd: str) -> str:
     """Get a post's URI. Arguments are the post's filename and publish_date.
 
@@ -68,29 +156,41 @@ def geturi(filename: str, pd: str) -> str:
     return pd[0:4] + "/" + pd[5:7] + "/" + filename
 
 
-def getdesc(content):
-    """Get a short description from the entire post content."""
+_stripper = None
 
-    from html.parser import HTMLParser
 
-    class HTMLStripper(HTMLParser):
-        def __init__(self):
-            super().__init__()
-            self.reset()
-            self.fed = []
-        def handle_data(self, d):
-            self.fed.append(d)
-        def get_data(self):
-            return ''.join(self.fed)
+def strip_tags(html: str) -> str:
+    """Get the text of an HTML fragment."""
 
-    def strip_tags(html):
-        s = HTMLStripper()
-        s.feed(html)
-        return s.get_data()
+    global _stripper
+    if _stripper is None:
+        # Defined on first use, so that html.parser is only imported then
+        from html.parser import HTMLParser
+
+        class HTMLStripper(HTMLParser):
+            def __init__(self):
+                super().__init__()
+                self.reset()
+                self.fed = []
+            def handle_data(self, d):
+                self.fed.append(d)
+            def get_data(self):
+                return ''.join(self.fed)
+        _stripper = HTMLStripper
+    s = _stripper()
+    s.feed(html)
+    return s.get_data()
+
+
+def getdesc(content):
+    """Get a short description from the entire post content."""
+
+    from markdown import markdown
 
     maxlen = 250
 
-    content = strip_tags(markdown(content.partition('\n\n')[0].strip()))
+    content = strip_tags(markdown(content.partition('\n\n')[0].strip(),
+                                  extensions=md_extensions))
     last_sentence_end = content.rfind('.', 0, maxlen)
     if last_sentence_end == -1:
         return content[0:maxlen]
@@ -98,287 +198,2055 @@ def getdesc(content):
         return content[0:last_sentence_end+1]
 
 
-def pubdate2str(pubdate, formatstr: str) -> str:
-    pd = datetime.strptime(pubdate, "%Y-%m-%d %H:%M:%S")
-    return pd.strftime(formatstr)
+def summaryend(content: str):
+    """Get the offset of the summary break in post content, or None if
+    there is no break."""
 
+    m = break_line.search(content)
+    return m.start() if m else None
 
-def getsummary(content: str) -> Tuple:
-    """Get everything from post content up to the break, returning a boolean and an HTML string.
 
-    If there is no break, return the whole thing."""
+def makeslug(title: str) -> str:
+    """Make the file name of a post, without .html, from its title.
+
+    Letters of other scripts are kept. The result is empty if the title has
+    no letters or digits, see postfilename()."""
+
+    import unicodedata
+
+    fromchars = "äöåøæđðčžš"
+    tochars = "aoaoaddczs"
+    transtable = str.maketrans(fromchars, tochars)
+
+    slug = title.replace(" ", "_").lower().translate(transtable)
+    # Leave out the accents of any other Latin letters
+    slug = "".join(
+        "".join(d for d in unicodedata.normalize("NFD", c) if not unicodedata.combining(d))
+        if unicodedata.name(c, "").startswith("LATIN ") else c
+        for c in unicodedata.normalize("NFC", slug))
+    return re.sub(r'[^\w\d]', "", slug).strip('_')
+
+
+def postfilename(title: str, post_id: int) -> str:
+    """Get the file name of a post from its title, or from its ID if the
+    title makes an empty slug."""
+
+    return (makeslug(title) or "post-{}".format(post_id)) + ".html"
+
+
+PostMeta = namedtuple("PostMeta", "summary_end description word_count reading_time")
+"""What is stored of a post besides its content, derived from the content
+when the post is written: the offset of the summary break (None if there
+is none), the description, the number of words and the reading time in
+minutes."""
+
+
+def postmeta(content: str) -> PostMeta:
+    """Derive the stored metadata of a post from its content."""
+
+    words = len(word_re.findall(content))
+    return PostMeta(summaryend(content), getdesc(content), words,
+                    max(1, -(-words // words_per_minute)))
+
+
+Rendered = namedtuple("Rendered", "html summary is_summary description")
+"""Everything generated from a post's Markdown content."""
+
+
+def render(content: str, summary_end: int = None, description: str = None) -> Rendered:
+    """Render post content to full HTML, summary HTML and description.
+
+    summary_end and description are the stored metadata of the post. If
+    description is None, the post has not been indexed and both are
+    derived from the content."""
+    from markdown import markdown
+
+    if description is None:
+        summary_end, description = summaryend(content), getdesc(content)
+    summary = content if summary_end is None else content[:summary_end]
+    return Rendered(markdown(content, extensions=md_extensions),
+                    markdown(summary, extensions=md_extensions),
+                    summary_end is not None, description)
+
+
+def renderkey(content: str) -> str:
+    """Get the render cache key for post content."""
+
+    return digest(md_extensions, break_re, content)
+
+
+def addcached(key: str, post_id: int, r: Rendered):
+    """Add newly rendered post content to the render cache."""
+
+    render_counts["rendered"] += 1
+    render_cache[key] = r
+    new_renders.append((key, post_id, r))
+
+
+def saverendercache():
+    """Store new render cache entries, replacing the old entries of the same
+    posts.
+
+    Entries of deleted posts are removed by the database (ON DELETE CASCADE)."""
+
+    global new_renders
+    cur.executemany("INSERT OR REPLACE INTO render_cache "
+                    "(post_id, hash, html, summary, is_summary, description) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    ((post_id, key) + tuple(r) for key, post_id, r in new_renders))
+    conn.commit()
+    new_renders = []
+
+
+class Template:
+    """A template in str.format syntax, split once into its literal text
+    and fields. Filling it in just lists the literal chunks and the values,
+    which are HTML-escaped for the fields named in escape."""
+
+    def __init__(self, text: str, escape: tuple = ()):
+        from string import Formatter
+
+        self.escape = frozenset(escape)
+        self.parts = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if literal:
+                self.parts.append(literal)
+            if field is not None:
+                self.parts.append((field, spec, conversion))
+
+    def value(self, part: Tuple, values: dict) -> str:
+        from html import escape
+
+        field, spec, conversion = part
+        v = values[field]
+        if conversion:
+            v = {"r": repr, "s": str, "a": ascii}[conversion](v)
+        v = format(v, spec) if spec else str(v)
+        return escape(v) if field in self.escape else v
+
+    def fill(self, **values) -> list:
+        """Fill in the fields. Returns the text as a list of chunks."""
+
+        return [part if part.__class__ is str else self.value(part, values)
+                for part in self.parts]
+
+    def partial(self, **values):
+        """Get a template with some of the fields filled in, like the ones
+        that are the same on every page of a build."""
+
+        t = Template("", self.escape)
+        for part in self.parts:
+            if part.__class__ is not str and part[0] in values:
+                part = self.value(part, values)
+            if part.__class__ is str and t.parts and t.parts[-1].__class__ is str:
+                t.parts[-1] += part
+            else:
+                t.parts.append(part)
+        return t
+
+
+def compiletemplates():
+    """Compile the templates of the pages for this build, filling in what is
+    the same on every page."""
+
+    global templates
+    conf = blog_conf["template"]
+    templates = {
+        "header": Template(header).partial(url=blog_conf["blog"]["url"],
+                                           author=blog_conf["author"]["name"],
+                                           locale=locale.getlocale()[0]),
+        "entry": Template("<h3><a href=\"{uri}\">{title}</a></h3>\n"
+                          "<p>{date}</p>\n{summary}", escape=("uri", "title")),
+        "read_more": Template("<p><a href=\"{uri}\">{read_more}</a></p>\n",
+                              escape=("uri",)).partial(
+            read_more=conf.get("read_more", "Read more...")),
+        "post": Template("<h3>{title}</h3>\n<p>{date}</p>\n{html}", escape=("title",)),
+        "tagsline": Template("<p class=\"tagsline\">{header} {tags}</p>\n").partial(
+            header=conf.get("tags_line_header", "Tags:")),
+        "tag": Template("<a href=\"{prefix}tag/{tag}.html\">{tag}</a>", escape=("tag",)),
+        "archive_post": Template("<li><a href=\"{uri}\">{title}</a> &mdash; {date}</li>",
+                                 escape=("uri", "title")),
+        "tag_count": Template("<li><a href=\"tag/{tag}.html\">{tag}</a> &mdash; "
+                              "{count} {posts}", escape=("tag",)).partial(
+            posts=conf.get("tags_posts", "posts")),
+    }
+
+
+def tagsline(tags: list, prefix: str = "") -> list:
+    """Get the linked tags line for a post from its list of tags."""
+
+    tag = templates["tag"]
+    return templates["tagsline"].fill(
+        tags=", ".join("".join(tag.fill(prefix=prefix, tag=t)) for t in tags))
+
+
+migrations = [
+    # 1: Build manifest, render cache and the index of published posts
+    """
+    CREATE TABLE IF NOT EXISTS `build_manifest` (
+        `path`	TEXT NOT NULL PRIMARY KEY,
+        `digest`	TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS `render_cache` (
+        `hash`	TEXT NOT NULL PRIMARY KEY,
+        `post_id`	INTEGER NOT NULL,
+        `html`	TEXT NOT NULL,
+        `summary`	TEXT NOT NULL,
+        `is_summary`	INTEGER NOT NULL,
+        `description`	TEXT NOT NULL,
+        FOREIGN KEY(`post_id`) REFERENCES posts("post_id") ON DELETE CASCADE
+    );
+    CREATE INDEX IF NOT EXISTS `render_cache_post` ON `render_cache` (`post_id`);
+    CREATE INDEX IF NOT EXISTS `post_visible_pub_date`
+        ON `posts` (`publish_date` DESC, `post_id` DESC) WHERE `hidden` = 0;
+    """,
+    # 2: Indexes for looking up tags and authors by post, which the
+    # generators, db_tagpost() and ON DELETE CASCADE need. tag_ref_i
+    # duplicates the index of the tag_post_unique constraint.
+    """
+    CREATE INDEX `tags_ref_post` ON `tags_ref` (`post_id`, `tag_id`);
+    CREATE INDEX `authors_ref_post` ON `authors_ref` (`post_id`);
+    CREATE INDEX `authors_ref_author` ON `authors_ref` (`author_id`);
+    DROP INDEX IF EXISTS `tag_ref_i`;
+    """,
+    # 3: Files imported with `challi import`, for resuming an interrupted
+    # import and writing the .htaccess redirects of the imported posts
+    """
+    CREATE TABLE `imported_files` (
+        `path`	TEXT NOT NULL PRIMARY KEY,
+        `post_id`	INTEGER NOT NULL,
+        `redirected`	INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+    # 4: Full-text index of the posts, kept in sync by triggers, and its
+    # words by post for the static search index
+    """
+    CREATE VIRTUAL TABLE `posts_fts` USING fts5(
+        title, content, content='posts', content_rowid='post_id',
+        tokenize='unicode61 remove_diacritics 2');
+    CREATE VIRTUAL TABLE `posts_fts_words` USING fts5vocab(posts_fts, instance);
+    CREATE TRIGGER `posts_fts_insert` AFTER INSERT ON `posts` BEGIN
+        INSERT INTO posts_fts (rowid, title, content)
+            VALUES (new.post_id, new.title, new.content);
+    END;
+    CREATE TRIGGER `posts_fts_delete` AFTER DELETE ON `posts` BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, title, content)
+            VALUES ('delete', old.post_id, old.title, old.content);
+    END;
+    CREATE TRIGGER `posts_fts_update` AFTER UPDATE OF title, content ON `posts` BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, title, content)
+            VALUES ('delete', old.post_id, old.title, old.content);
+        INSERT INTO posts_fts (rowid, title, content)
+            VALUES (new.post_id, new.title, new.content);
+    END;
+    INSERT INTO posts_fts (posts_fts) VALUES ('rebuild');
+    """,
+    # 5: Content hash of each generated file and what was uploaded where,
+    # for uploading only the files that changed
+    """
+    ALTER TABLE `build_manifest` ADD COLUMN `hash` TEXT;
+    CREATE TABLE `uploaded` (
+        `dest`	TEXT NOT NULL,
+        `path`	TEXT NOT NULL,
+        `state`	TEXT NOT NULL,
+        PRIMARY KEY (`dest`, `path`)
+    ) WITHOUT ROWID;
+    """,
+    # 6: Indexes for listing the posts by title or date, each in the order
+    # that ls breaks ties in
+    """
+    CREATE INDEX `post_title` ON `posts` (`title`);
+    DROP INDEX `post_pub_date`;
+    CREATE INDEX `post_pub_date` ON `posts` (`publish_date` DESC, `post_id` DESC);
+    """,
+    # 7: Metadata derived from the content when a post is written, see
+    # PostMeta. NULL until `challi reindex` fills it in for older posts.
+    """
+    ALTER TABLE `posts` ADD COLUMN `summary_end` INTEGER;
+    ALTER TABLE `posts` ADD COLUMN `description` TEXT;
+    ALTER TABLE `posts` ADD COLUMN `word_count` INTEGER;
+    ALTER TABLE `posts` ADD COLUMN `reading_time` INTEGER;
+    """,
+    # 8: Posts changed since the last build, for rebuild --pending and the
+    # worker. Not a foreign key, as deleted posts need rebuilding too.
+    """
+    CREATE TABLE `rebuild_queue` (
+        `post_id`	INTEGER NOT NULL PRIMARY KEY,
+        `queued_at`	REAL NOT NULL
+    );
+    """,
+    # 9: Render cache keyed by post, so that scanposts() can join it to the
+    # posts. Only the latest render of each post is kept.
+    """
+    CREATE TABLE `render_cache_post_id` (
+        `post_id`	INTEGER NOT NULL PRIMARY KEY,
+        `hash`	TEXT NOT NULL,
+        `html`	TEXT NOT NULL,
+        `summary`	TEXT NOT NULL,
+        `is_summary`	INTEGER NOT NULL,
+        `description`	TEXT NOT NULL,
+        FOREIGN KEY(`post_id`) REFERENCES posts("post_id") ON DELETE CASCADE
+    );
+    INSERT OR REPLACE INTO `render_cache_post_id`
+        SELECT post_id, hash, html, summary, is_summary, description FROM `render_cache`;
+    DROP TABLE `render_cache`;
+    ALTER TABLE `render_cache_post_id` RENAME TO `render_cache`;
+    """,
+    # 10: Posts in the static search index as of the last build, for
+    # rewriting only the shards of the posts that changed. Not a foreign
+    # key, as the shards of deleted posts need rewriting too.
+    """
+    CREATE TABLE `search_posts` (
+        `post_id`	INTEGER NOT NULL PRIMARY KEY,
+        `digest`	TEXT NOT NULL,
+        `prefixes`	TEXT NOT NULL
+    );
+    """,
+]
+"""Schema migrations. The schema version of a database, kept in
+PRAGMA user_version, is the number of migrations applied to it."""
+
+
+db_defaults = {"journal_mode": "wal",
+               "synchronous": "normal",
+               "cache_size": "-65536",
+               "mmap_size": "268435456",
+               "temp_store": "memory",
+               "cached_statements": "256"}
+"""Defaults of the [database] config section, tuned for full rebuilds."""
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that adds the time spent in SQLite to sql_time."""
+
+    def execute(self, *args):
+        global sql_time
+        start = perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            sql_time += perf_counter() - start
+
+    def executemany(self, *args):
+        global sql_time
+        start = perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            sql_time += perf_counter() - start
+
+    def fetchone(self):
+        global sql_time
+        start = perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            sql_time += perf_counter() - start
+
+    def fetchall(self):
+        global sql_time
+        start = perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            sql_time += perf_counter() - start
+
+    def __next__(self):
+        global sql_time
+        start = perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            sql_time += perf_counter() - start
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors are TimedCursors."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+def connect(filename: str) -> sqlite3.Connection:
+    """Open the database with the settings of the [database] config section."""
+
+    settings = dict(db_defaults)
+    if blog_conf is not None and blog_conf.has_section("database"):
+        settings.update(blog_conf["database"])
+    db = sqlite3.connect(filename, factory=TimedConnection,
+                         cached_statements=int(settings["cached_statements"]))
+    db.execute("PRAGMA foreign_keys=1")
+    for pragma in ("journal_mode", "synchronous", "cache_size", "mmap_size",
+                   "temp_store"):
+        value = settings[pragma]
+        if not re.fullmatch(r"-?\w+", value):
+            raise click.BadParameter("Invalid value for {}: {}".format(pragma, value),
+                                     param_hint="[database]")
+        db.execute("PRAGMA {}={}".format(pragma, value))
+    return db
+
+
+def migrate(db: sqlite3.Connection):
+    """Apply the schema migrations a database is missing."""
+
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version > len(migrations):
+        raise click.ClickException("Database schema version {} is newer than "
+                                   "this program supports ({})".format(
+                                       version, len(migrations)))
+    for number, script in enumerate(migrations[version:], start=version + 1):
+        if version > 0:
+            click.echo("Upgrading database schema to version %d" % number, err=True)
+        db.executescript("BEGIN;\n{}\nPRAGMA user_version = {};\nCOMMIT;".
+                         format(script, number))
 
-    p = re.compile(break_re)
-    is_summary = False
-    ret = ""
-    for r in content.splitlines(keepends=True):
-        if p.match(r):
-            is_summary = True
-            break
-        else:
-            ret += r
-    return is_summary, markdown(ret)
 
+def countsql(statement: str):
+    """Count the SQL statements run on the connection.
 
-def gettagsline(post_id: int, prefix: str = "") -> str:
-    """Get the tags for a post by id"""
+    The statements that triggers and virtual tables such as FTS5 run
+    internally, which are traced with a leading "--", are not counted."""
 
-    cur_inner = conn.cursor()
-    cur_inner.execute("SELECT tags.text AS tag FROM tags, posts, tags_ref "
-                      "WHERE tags.tag_id = tags_ref.tag_id AND "
-                      "posts.post_id = tags_ref.post_id AND "
-                      "posts.post_id = ?", (post_id,))
-    return ", ".join("<a href=\"{prefix}tag/{tag}.html\">{tag}</a>".
-                     format(tag=r[0], prefix=prefix) for r in cur_inner)
+    global sql_count
+    if not statement.startswith("--"):
+        sql_count += 1
 
 
-def split_input(post_text: str) -> Tuple:
-    body = ""
+def split_input(post_text: str, tags_header: str = None) -> Tuple:
+    """Split the text of a post into its title, body and list of tags.
+
+    The tags are on a line starting with tags_header, by default the
+    configured tags_line_header."""
+    if tags_header is None:
+        tags_header = blog_conf["template"]["tags_line_header"]
+    prefix = "{} ".format(tags_header)
+    title = ""
+    body = []
+    tags = []
     for i, line in enumerate(post_text.splitlines()):
         if i == 0:
             title = line.strip()
-        elif line.startswith("{} ".format(blog_conf["template"]["tags_line_header"])):
-            tags = line.strip(). \
-                replace("{} ".format(blog_conf["template"]["tags_line_header"]), "", 1). \
-                split(", ")
+        elif line.startswith(prefix):
+            tags = line.strip().replace(prefix, "", 1).split(", ")
         else:
-            body += line + "\n"
-    return title, body, tags
+            body.append(line + "\n")
+    return title, "".join(body), tags
+
+
+def digest(*parts) -> str:
+    """Get a stable hash of some build inputs."""
+
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(repr(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def confdigest() -> str:
+    """Get a hash of the inputs shared by every page: header, footer, the
+    config in page_config and this program itself, so that upgrading it
+    regenerates everything."""
+
+    conf = [(s, [(k, v) for k, v in sorted(blog_conf.items(s, raw=True))
+                 if keys is None or k in keys])
+            for s, keys in page_config if blog_conf.has_section(s)]
+    return digest(header, footer, locale.getlocale(), conf, filedigest(__file__))
+
+
+def loadmanifest():
+    """Load the build manifest of the previous build from the database."""
+
+    global manifest, built, base_digest, regenerated
+    manifest = {r["path"]: r["digest"] for r in
+                cur.execute("SELECT path, digest FROM build_manifest")}
+    built = {}
+    base_digest = confdigest()
+    regenerated = set()
+
+
+def needs_build(relpath: str, *inputs) -> bool:
+    """Check whether a generated file must be written.
+
+    relpath is relative to blog_dir and inputs are everything the file's
+    content depends on. The file is recorded as part of this build either way.
+    When only is set, just that file is made."""
+
+    if only is not None:
+        return relpath == only
+    d = digest(base_digest, *inputs)
+    if relpath in built:
+        click.echo("Warning: {} is generated more than once".format(relpath), err=True)
+    built[relpath] = d
+    if full_build or manifest.get(relpath) != d or \
+            not path.isfile(path.join(blog_conf["files"]["blog_dir"], relpath)):
+        regenerated.add(relpath)
+        return True
+    return False
+
+
+class Output:
+    """Writer for generated files.
+
+    Files are written to a temporary file in the same directory and moved
+    into place with os.replace(), so a web server never sees a partially
+    written page. Files whose content did not change are left alone, which
+    keeps their mtime for rsync and HTTP caching."""
+
+    def __init__(self, root: str):
+        import os
+        self.root = root
+        self.written = 0
+        self.bytes = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.hashes = {}
+        """SHA-1 of the files written or found unchanged, by path, in order."""
+        # Temporary files are created with mode 0600, give them the usual one
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = 0o666 & ~umask
+
+    def write(self, relpath: str, chunks) -> bool:
+        """Write a file from an iterable of strings.
+
+        Returns True if the file was written, False if it was unchanged."""
+
+        data = [chunk.encode("utf-8") for chunk in chunks]
+        self.hashes[relpath] = h = datadigest(data)
+        if not replacefile(path.join(self.root, relpath), data, self.mode, h):
+            self.unchanged += 1
+            return False
+        self.written += 1
+        self.bytes += sum(map(len, data))
+        return True
+
+    def remove(self, relpath: str):
+        """Remove a generated file, its precompressed siblings and any
+        directories it leaves empty."""
+
+        import os
+
+        target = path.join(self.root, relpath)
+        try:
+            os.remove(target)
+            self.deleted += 1
+        except FileNotFoundError:
+            pass
+        for suffix in compressors:
+            try:
+                os.remove(target + suffix)
+            except FileNotFoundError:
+                pass
+        # Attempt to prune the directory tree the file was in
+        try:
+            os.removedirs(path.dirname(target))
+        except OSError:
+            pass
 
+    def makedirs(self, reldir: str = "", mode: int = 0o777):
+        """Make a directory and its parents, if they don't exist."""
 
-def makeindex():
-    """Make the main index.html"""
-
-    global header
-    makedirs(blog_conf["files"]["blog_dir"], exist_ok=True)
-    idxf = open(path.join(blog_conf["files"]["blog_dir"],
-                          blog_conf.get("files", "index_file", fallback="index.html")),
-                'w+', encoding="utf-8")
-
-    # Customize header
-    temp_header = header.format(title=blog_conf["blog"]["title"],
-                               url=blog_conf["blog"]["url"],
-                               description=blog_conf["blog"]["description"],
-                               author=blog_conf["author"]["name"],
-                               locale=locale.getlocale()[0])
-    idxf.write(temp_header)
-    cur.execute("SELECT post_id, title, publish_date, filename, content "
-                "FROM posts ORDER BY publish_date DESC LIMIT ?",
-                (index_len,))
-    with click.progressbar(cur, label="Making index.html", width=0) as posts:
-        for row in posts:
-            pdstring = pubdate2str(row["publish_date"],
-                                   blog_conf["template"]["date_format"])
-            outfile = geturi(row["filename"], row["publish_date"])
-            is_summary, summary = getsummary(row["content"])
-            idxf.write("<h3><a href=\"{outfile}\">{title}</a></h3>\n"
-                       "<p>{publish_date}</p>\n{summary}"
-                       .format(outfile=outfile,
-                               publish_date=pdstring,
-                               title=row["title"],
-                               summary=summary))
-            if is_summary:
-                idxf.write("<p><a href=\"{}\">{}</a></p>\n"
-                           .format(outfile,
-                                   blog_conf.get("template", "read_more", fallback="Read more...")))
-            idxf.write("<p class=\"tagsline\">{} {}</p>\n".
-                       format(blog_conf["template"]["tags_line_header"],
-                              gettagsline(row["post_id"])))
-    idxf.write(footer)
-    idxf.close()
-
-
-def writeposts():
-    """Write posts to files. Also make any necessary subdirectories."""
-
-    global header
-    cur.execute("SELECT post_id, title, publish_date, filename, content "
-                "FROM posts")
-    with click.progressbar(cur, label="Writing posts", width=0) as posts:
-        for row in posts:
-            pdstring = pubdate2str(row["publish_date"],
-                                   blog_conf["template"]["date_format"])
-            datedir = path.join(row["publish_date"][0:4], row["publish_date"][5:7])
-            makedirs(path.join(blog_conf["files"]["blog_dir"], datedir),
-                     mode=0o750, exist_ok=True)
-            outfile = path.join(blog_conf["files"]["blog_dir"], datedir, row["filename"])
-            # Write each post file
-            with open(outfile, 'w', encoding="utf-8") as f:
-                tag_title = "{} &ndash; {}".format(
-                    blog_conf["blog"]["title"],
-                    row["title"])
-                desc = getdesc(row["content"])
-                temp_header = header.format(title=tag_title,
-                               url=blog_conf["blog"]["url"],
-                               description=desc,
-                               author=blog_conf["author"]["name"],
-                               locale=locale.getlocale()[0])
-                f.write(temp_header)
-                f.write("<h3>" + row["title"] + "</h3>\n" + "<p>" + pdstring + "</p>\n")
-                f.write(markdown(row["content"]))
-                f.write("<p class=\"tagsline\">{} {}</p>\n".
-                        format(blog_conf.get("template", "tags_line_header", fallback="Tags:"),
-                               gettagsline(row["post_id"], "../../")))
-                f.write(footer)
+        makedirs(path.join(self.root, reldir), mode=mode, exist_ok=True)
 
 
-def makefullidx():
-    """Make an index page listing all posts."""
-
-    global header
-    makedirs(blog_conf["files"]["blog_dir"], exist_ok=True)
-    archive_index = blog_conf.get("files", "archive_index", fallback="all_posts.html")
-    f = open(path.join(blog_conf["files"]["blog_dir"], archive_index),
-             'w', encoding="utf-8")
-
-    # Customize header
-    archive_title = blog_conf["blog"]["title"] + \
-                    " &ndash; " + \
-                    blog_conf["template"]["archive_title"]
-    temp_header = header.format(title=archive_title,
-                               url=blog_conf["blog"]["url"],
-                               description=archive_title,
-                               author=blog_conf["author"]["name"],
-                               locale=locale.getlocale()[0])
-    f.write(temp_header)
-    f.write("<h2>{}</h2>".format(blog_conf["template"]["archive_title"]))
-    prevmonth = None
-    cur.execute("SELECT title, publish_date, filename "
-                "FROM posts ORDER BY publish_date DESC")
-
-    with click.progressbar(cur, label="Making %s" % archive_index, width=0) as posts:
-        for row in posts:
-            pd = datetime.strptime(row["publish_date"], "%Y-%m-%d %H:%M:%S")
-            thismonth = (pd.year, pd.month)
-            if thismonth != prevmonth:
-                if prevmonth is not None:
-                    f.write("</ul>\n")
-                f.write("<h3>" + pubdate2str(row["publish_date"], "%B %Y") + "</h3>\n<ul>")
-            f.write("<li><a href=\"%s\">%s</a> &mdash; %s</li>" %
-                    (geturi(row["filename"], row["publish_date"]),
-                     row["title"],
-                     pubdate2str(row["publish_date"],
-                                 blog_conf["template"]["date_format"]))
-                    )
-            prevmonth = thismonth
-    f.write("</ul>" + footer)
-    f.close()
+class MemoryOutput(Output):
+    """Writer that keeps the generated files in memory, by path."""
 
+    def __init__(self):
+        super().__init__("")
+        self.files = {}
 
-def maketagindex():
+    def write(self, relpath: str, chunks) -> bool:
+        self.files[relpath] = "".join(chunks).encode("utf-8")
+        self.written += 1
+        self.bytes += len(self.files[relpath])
+        return True
+
+    def remove(self, relpath: str):
+        self.files.pop(relpath, None)
+
+    def makedirs(self, reldir: str = "", mode: int = 0o777):
+        pass
+
+
+def datadigest(data: list) -> str:
+    """Get the SHA-1 hex digest of a list of byte strings, as filedigest()
+    would of a file with that content."""
+
+    h = hashlib.sha1()
+    for chunk in data:
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def replacefile(target: str, data: list, mode: int, digest: str = None) -> bool:
+    """Atomically write a list of byte strings to target, unless the file
+    already has that content. digest is datadigest(data), if known. Returns
+    True if the file was written."""
+
+    import os
+    import tempfile
+
+    if filedigest(target, sum(map(len, data))) == (digest or datadigest(data)):
+        return False
+    dirname = path.dirname(target)
+    makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".challi-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.writelines(data)
+        os.chmod(tmp, mode)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+def gzipdata(data: bytes) -> bytes:
+    import gzip
+    # No timestamp in the header, so that the same input gives the same file
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def brotlidata(data: bytes) -> bytes:
+    import brotli
+    return brotli.compress(data, quality=11)
+
+
+compressors = {".gz": gzipdata, ".br": brotlidata}
+"""Compression functions of the precompressed siblings, by file suffix."""
+
+precompress_formats = {"gzip": ".gz", "br": ".br"}
+"""File suffixes of the formats of the precompress setting."""
+
+
+def precompressed() -> list:
+    """Get the suffixes of the configured precompressed siblings."""
+
+    suffixes = []
+    for name in blog_conf.get("files", "precompress", fallback="").split(","):
+        name = name.strip()
+        if not name:
+            continue
+        if name not in precompress_formats:
+            raise click.UsageError("Unknown precompress format `%s'" % name)
+        if name == "br":
+            try:
+                import brotli  # noqa: F401
+            except ImportError:
+                raise click.UsageError("precompress=br needs the brotli module "
+                                       "(pip install brotli)")
+        suffixes.append(precompress_formats[name])
+    return suffixes
+
+
+def compressfile(job: Tuple) -> Tuple:
+    """Make the precompressed siblings of a file.
+
+    job is the file name, the suffixes of the siblings and their file mode.
+    A sibling whose mtime is that of the file is taken to be up to date and
+    is left alone, as is one whose content would not change; written
+    siblings get the file's mtime. Returns the number of siblings and bytes
+    written."""
+
+    import os
+
+    filename, suffixes, mode = job
+    st = os.stat(filename)
+    data = None
+    written = size = 0
+    for suffix in suffixes:
+        target = filename + suffix
+        try:
+            if os.stat(target).st_mtime_ns == st.st_mtime_ns:
+                continue
+        except FileNotFoundError:
+            pass
+        if data is None:
+            with open(filename, "rb") as f:
+                data = f.read()
+        compressed = compressors[suffix](data)
+        if replacefile(target, [compressed], mode):
+            written += 1
+            size += len(compressed)
+        os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return written, size
+
+
+def precompress(suffixes: list, jobs: int = 1) -> Tuple:
+    """Make the precompressed siblings with the given suffixes of the files
+    of this build, including the ones that were up to date, and of the CSS
+    files in blog_dir, with jobs worker processes. Siblings that are up to
+    date are left alone, see compressfile(). Siblings of other formats are
+    removed. Returns the number of siblings and bytes written."""
+
+    import os
+
+    root = blog_conf["files"]["blog_dir"]
+    css = [c.strip() for c in blog_conf["files"]["css_include"].split(",")]
+    files = [path.join(root, p) for p in
+             dict.fromkeys(list(built) + [c for c in css if c])
+             if p.endswith(compressible) and path.isfile(path.join(root, p))]
+    for suffix in compressors:
+        if suffix not in suffixes:
+            for filename in files:
+                try:
+                    os.remove(filename + suffix)
+                except FileNotFoundError:
+                    pass
+    if not suffixes or not files:
+        return 0, 0
+    todo = ((filename, suffixes, output.mode) for filename in files)
+    if jobs > 1 and len(files) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(compressfile, todo,
+                                    chunksize=max(1, len(files) // (jobs * 4))))
+    else:
+        results = list(map(compressfile, todo))
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def filedigest(filename: str, size: int = None):
+    """Get the SHA-1 hex digest of a file's content.
+
+    Returns None if the file does not exist or, when size is given, if
+    the file is not of that size."""
+
+    import os
+
+    try:
+        if size is not None and os.stat(filename).st_size != size:
+            return None
+        with open(filename, "rb") as f:
+            h = hashlib.sha1()
+            for block in iter(lambda: f.read(65536), b""):
+                h.update(block)
+            return h.hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def savemanifest():
+    """Store the manifest of this build and remove generated files that are
+    no longer part of it."""
+
+    changed = [(p, d, output.hashes.get(p)) for p, d in built.items()
+               if manifest.get(p) != d or p in output.hashes]
+    stale = [p for p in manifest if p not in built]
+    for p in stale:
+        output.remove(p)
+    cur.executemany("DELETE FROM build_manifest WHERE path = ?",
+                    ((p,) for p in stale))
+    # Files carried over from the previous build keep their hash
+    cur.executemany("INSERT INTO build_manifest (path, digest, hash) VALUES (?, ?, ?) "
+                    "ON CONFLICT (path) DO UPDATE SET digest = excluded.digest, "
+                    "hash = coalesce(excluded.hash, hash)", changed)
+    conn.commit()
+
+
+Post = namedtuple("Post", "post_id title content publish_date filename tags pd uri "
+                         "summary_end description key rendered")
+"""A post as read by scanposts(), with its tags, parsed publish date, URI,
+stored metadata, render cache key and rendered content, which is None if
+the content is not in the render cache."""
+
+
+def scanposts(where: str = "", params: Tuple = (), limit: int = None):
+    """Read all published posts with their tags, newest first.
+
+    Hidden posts (drafts) are left out. The query is answered from the
+    partial index post_visible_pub_date, and the render cache is joined
+    in. where is an extra condition on the posts, with its parameters in
+    params, and limit the number of posts to read at most."""
+
+    cur.execute("SELECT post_id, title, content, publish_date, filename, "
+                "summary_end, posts.description, "
+                "(SELECT group_concat(text, char(31)) FROM "
+                " (SELECT tags.text FROM tags_ref, tags "
+                "  WHERE tags.tag_id = tags_ref.tag_id "
+                "  AND tags_ref.post_id = posts.post_id "
+                "  ORDER BY tags_ref.tag_ref_id)) AS tags, "
+                "hash, html, summary, is_summary, "
+                "render_cache.description AS rendered_description "
+                "FROM posts LEFT JOIN render_cache USING (post_id) "
+                "WHERE hidden = 0 " + (where and "AND " + where + " ") +
+                "ORDER BY publish_date DESC, post_id DESC LIMIT ?",
+                tuple(params) + (-1 if limit is None else limit,))
+    for row in cur:
+        key = renderkey(row["content"])
+        rendered = None
+        if row["hash"] == key:
+            render_counts["db_hits"] += 1
+            rendered = Rendered(row["html"], row["summary"], bool(row["is_summary"]),
+                                row["rendered_description"])
+        yield Post(row["post_id"], row["title"], row["content"],
+                   row["publish_date"], row["filename"],
+                   row["tags"].split("\x1f") if row["tags"] else [],
+                   datetime.strptime(row["publish_date"], "%Y-%m-%d %H:%M:%S"),
+                   geturi(row["filename"], row["publish_date"]),
+                   row["summary_end"], row["description"], key, rendered)
+
+
+def renderposts(posts, jobs: int = 1):
+    """Render the posts whose content is not in the render cache, before
+    the page generators see them. Yields the posts with their rendered
+    content.
+
+    Posts are read render_batch at a time. With jobs > 1 the posts of a
+    batch to render are rendered in that many worker processes, while the
+    posts before them are already passed on."""
+
+    pool = None
+    try:
+        while True:
+            batch = list(islice(posts, render_batch))
+            if not batch:
+                return
+            misses = []
+            for i, post in enumerate(batch):
+                if post.rendered is None:
+                    rendered = render_cache.get(post.key)
+                    if rendered is None:
+                        misses.append(post)
+                    else:
+                        render_counts["memory_hits"] += 1
+                        batch[i] = post._replace(rendered=rendered)
+            if not misses:
+                yield from batch
+                continue
+            render_counts["misses"] += len(misses)
+            args = ([p.content for p in misses], [p.summary_end for p in misses],
+                    [p.description for p in misses])
+            if jobs > 1 and len(misses) > 1:
+                if pool is None:
+                    from concurrent.futures import ProcessPoolExecutor
+                    pool = ProcessPoolExecutor(max_workers=jobs)
+                renders = pool.map(render, *args,
+                                   chunksize=max(1, len(misses) // (jobs * 4)))
+            else:
+                renders = map(render, *args)
+            for post in batch:
+                if post.rendered is None:
+                    with stage("render"):
+                        rendered = next(renders)
+                    addcached(post.key, post.post_id, rendered)
+                    post = post._replace(rendered=rendered)
+                yield post
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def tagposts(tag: str):
+    """Read the published posts tagged tag, newest first."""
+
+    return scanposts("post_id IN (SELECT tags_ref.post_id FROM tags_ref, tags "
+                     "WHERE tags.tag_id = tags_ref.tag_id AND tags.text = ?)", (tag,))
+
+
+def postinputs(post: Post) -> Tuple:
+    """Get the inputs of a post that pages listing it depend on."""
+
+    return post.post_id, post.title, post.content, post.publish_date, \
+        post.filename, post.tags
+
+
+class Sink:
+    """A page generator. build() feeds it every post, newest first, and
+    closes it once all posts have been read."""
+
+    def begin(self, count: int):
+        """Called by build() with the number of posts, before the first one,
+        when it reads all of them."""
+        pass
+
+    def add(self, post: Post):
+        pass
+
+    def close(self):
+        pass
+
+
+class Stats:
+    """Wall and CPU time, SQL statements and SQL time of the stages of a
+    build, for rebuild --stats.
+
+    Time is charged to one stage at a time: while another stage is entered
+    within a stage, it is not charged to the outer one."""
+
+    def __init__(self):
+        self.stages = {}
+        self.current = "other"
+        self.mark = self.now()
+
+    @staticmethod
+    def now() -> Tuple:
+        return perf_counter(), process_time(), sql_count, sql_time
+
+    def switch(self, name: str) -> str:
+        """Start charging to stage name. Returns the previous stage."""
+
+        now = self.now()
+        totals = self.stages.setdefault(self.current, [0, 0, 0, 0])
+        for i, (a, b) in enumerate(zip(self.mark, now)):
+            totals[i] += b - a
+        previous, self.current, self.mark = self.current, name, now
+        return previous
+
+    def asdict(self) -> dict:
+        self.switch(self.current)
+        return {name: {"wall": round(wall, 6), "cpu": round(cpu, 6),
+                       "sql_statements": count, "sql_time": round(t, 6)}
+                for name, (wall, cpu, count, t) in self.stages.items()}
+
+
+@contextmanager
+def stage(name: str):
+    """Charge the time of the block to stage name, if stats are kept."""
+
+    if stats is None:
+        yield
+        return
+    previous = stats.switch(name)
+    try:
+        yield
+    finally:
+        stats.switch(previous)
+
+
+def build(sinks: list, posts=None, jobs: int = 1):
+    """Read the posts once and feed them to each of the page generators.
+
+    posts is an iterable of the posts to read instead of all of them,
+    which is read without a progress bar. Posts not in the render cache
+    are rendered in jobs processes, see renderposts()."""
+
+    global output
+    if output is None:
+        output = Output(blog_conf["files"]["blog_dir"])
+    output.makedirs()
+    if posts is None:
+        with stage("scan"):
+            count = postcount()
+        for sink in sinks:
+            sink.begin(count)
+        with click.progressbar(scanposts(), length=count,
+                               label="Reading posts", width=0) as bar:
+            feedsinks(sinks, renderposts(iter(bar), jobs))
+    else:
+        feedsinks(sinks, renderposts(iter(posts), jobs))
+    for sink in sinks:
+        with stage(type(sink).__name__):
+            sink.close()
+
+
+def feedsinks(sinks: list, posts):
+    """Feed posts to each of the page generators."""
+
+    if stats is None:
+        for post in posts:
+            for sink in sinks:
+                sink.add(post)
+        return
+    named = [(type(sink).__name__, sink) for sink in sinks]
+    previous = stats.switch("scan")
+    for post in posts:
+        for name, sink in named:
+            stats.switch(name)
+            sink.add(post)
+        stats.switch("scan")
+    stats.switch(previous)
+
+
+Entry = namedtuple("Entry", "post_id title uri publish_date date tags inputs rendered")
+"""What a page listing posts needs of a post: date is the formatted publish
+date, inputs a digest of the post's inputs and rendered its rendered content."""
+
+_entry = None
+
+
+def postentry(post: Post) -> Entry:
+    """Get the listing entry of a post. The entry of the post last asked
+    for is kept, as every listing page generator asks for the same post."""
+
+    global _entry
+    if _entry is None or _entry[0] is not post:
+        _entry = (post, Entry(post.post_id, post.title, post.uri, post.publish_date,
+                              post.pd.strftime(blog_conf["template"]["date_format"]),
+                              tuple(post.tags), digest(*postinputs(post)),
+                              post.rendered))
+    return _entry[1]
+
+
+def entryhtml(e: Entry, prefix: str = "") -> list:
+    """Make the HTML of a post on a page listing posts: title, date, summary
+    and tags. prefix is the relative path from the page to blog_dir."""
+
+    postpath = prefix + e.uri
+    html = templates["entry"].fill(uri=postpath, title=e.title, date=e.date,
+                                   summary=e.rendered.summary)
+    if e.rendered.is_summary:
+        html.extend(templates["read_more"].fill(uri=postpath))
+    html.extend(tagsline(e.tags, prefix))
+    return html
+
+
+def pageheader(title: str, description: str = None) -> list:
+    """Customize the header for a page. title and description are HTML."""
+
+    return templates["header"].fill(
+        title=title, description=description if description is not None else title)
+
+
+def postcount() -> int:
+    """Get the number of published posts."""
+
+    return conn.execute("SELECT COUNT(*) FROM posts WHERE hidden = 0").fetchone()[0]
+
+
+def indexkey(number: int, count: int):
+    """Get the (publish_date, post_id) of the newest post of index page
+    number, or None if there is no such page. count is the number of posts."""
+
+    if number < 1 or (number - 1) * index_len >= count:
+        return None
+    if number not in index_keys:
+        row = conn.execute("SELECT publish_date, post_id FROM posts WHERE hidden = 0 "
+                           "ORDER BY publish_date, post_id LIMIT 1 OFFSET ?",
+                           (min(number * index_len, count) - 1,)).fetchone()
+        if row is None:
+            return None
+        index_keys[number] = tuple(row)
+    return index_keys[number]
+
+
+def indexpath(number: int = None) -> str:
+    """Get the path of an index page by page number, relative to blog_dir.
+    Without a number, get the path of the main index."""
+
+    if number is None:
+        return blog_conf.get("files", "index_file", fallback="index.html")
+    return "page/{}.html".format(number)
+
+
+class IndexPages(Sink):
+    """Make the main index.html, listing the index_len newest posts, and
+    the pages of older posts, page/1.html, page/2.html and so on, each
+    listing index_len posts.
+
+    The pages are numbered from the oldest post, page 1 being the oldest,
+    so that a new post only changes the main index and the newest pages.
+    Pages with only posts that are on the main index are left out.
+
+    Pages are cut from the posts as they stream in, newest first, so only
+    the posts of the current page and the main index are kept in memory.
+    count is the number of posts, which build() tells if it is not given,
+    and first the position of the first post fed, newest first, when the
+    posts start further down the index."""
+
+    def __init__(self, count: int = None, first: int = 0):
+        self.count = count
+        self.position = first
+        self.index = []
+        self.number = None
+        self.entries = []
+
+    def begin(self, count: int):
+        if self.count is None:
+            self.count = count
+
+    def add(self, post: Post):
+        e = postentry(post)
+        if self.position < index_len:
+            self.index.append(e)
+        number = self.pagenumber(self.position)
+        self.position += 1
+        if number != self.number:
+            self.writepage()
+            self.number = number
+        self.entries.append(e)
+
+    def close(self):
+        self.writepage()
+        self.writeindex()
+
+    def pagenumber(self, position: int) -> int:
+        """Get the number of the page of the post at position, newest first."""
+
+        return (self.count - 1 - position) // index_len + 1
+
+    def haspage(self, number: int) -> bool:
+        """Check whether page number has a post that is not on the main index."""
+
+        return number >= 1 and (number - 1) * index_len < self.count - index_len
+
+    def link(self, relpath: str, target: str, text: str, fallback: str) -> str:
+        return "<a href=\"{}\">{}</a>".format(
+            path.relpath(target, path.dirname(relpath) or "."),
+            blog_conf.get("template", text, fallback=fallback))
+
+    def writeindex(self):
+        """Write the main index."""
+
+        relpath = indexpath()
+        older = self.pagenumber(index_len) if self.count > index_len else None
+        if not needs_build(relpath, [e.inputs for e in self.index], older):
+            return
+        page = pageheader(blog_conf["blog"]["title"], blog_conf["blog"]["description"])
+        for e in self.index:
+            page.extend(entryhtml(e))
+        if older is not None:
+            page.append("<p class=\"pagination\">{}</p>\n".format(
+                self.link(relpath, indexpath(older), "older_posts", "Older posts")))
+        page.append(footer)
+        output.write(relpath, page)
+
+    def writepage(self):
+        """Write the page of the current page number."""
+
+        number, entries = self.number, self.entries
+        self.entries = []
+        if number is None or not self.haspage(number):
+            return
+        relpath = indexpath(number)
+        index_keys[number] = entries[0].publish_date, entries[0].post_id
+        newer = indexpath(number + 1) if self.haspage(number + 1) else indexpath()
+        if not needs_build(relpath, [e.inputs for e in entries], newer):
+            return
+        page = pageheader("{} &ndash; {} {}".format(
+            blog_conf["blog"]["title"],
+            blog_conf.get("template", "page", fallback="Page"),
+            number))
+        for e in entries:
+            page.extend(entryhtml(e, "../"))
+        nav = [self.link(relpath, newer, "newer_posts", "Newer posts")]
+        if number > 1:
+            nav.append(self.link(relpath, indexpath(number - 1), "older_posts", "Older posts"))
+        page.append("<p class=\"pagination\">{}</p>\n".format(" &mdash; ".join(nav)))
+        page.append(footer)
+        output.write(relpath, page)
+
+
+def postpage(post: Post) -> list:
+    """Make the HTML page of a single post."""
+
+    from html import escape
+
+    pdstring = post.pd.strftime(blog_conf["template"]["date_format"])
+    tag_title = "{} &ndash; {}".format(
+        blog_conf["blog"]["title"],
+        escape(post.title))
+    page = pageheader(tag_title, post.rendered.description)
+    page.extend(templates["post"].fill(title=post.title, date=pdstring,
+                                       html=post.rendered.html))
+    page.extend(tagsline(post.tags, "../../"))
+    page.append(footer)
+    return page
+
+
+class PostPages(Sink):
+    """Write posts to files. Also make any necessary subdirectories.
+
+    The posts come rendered, see renderposts()."""
+
+    def add(self, post: Post):
+        if needs_build(post.uri, postinputs(post)):
+            output.makedirs(path.dirname(post.uri), mode=0o750)
+            # Write each post file
+            output.write(post.uri, postpage(post))
+
+
+class ArchivePages(Sink):
+    """Make the archive: a page for each month listing its posts (2024/05.html),
+    a page for each year listing the titles of its posts (2024/index.html),
+    and the archive index (all_posts.html) listing the years and months.
+
+    Month pages are not in the month directories, where any name could be
+    the file name of a post.
+
+    Posts come newest first, so each month and year page is written as
+    soon as the posts of the next one start."""
+
+    def __init__(self):
+        self.month = None
+        self.entries = []
+        self.year = None
+        self.months = []
+        self.years = []
+
+    def add(self, post: Post):
+        if (post.pd.year, post.pd.month) != self.month:
+            self.closemonth()
+            if post.pd.year != self.year:
+                self.closeyear()
+                self.year = post.pd.year
+            self.month = (post.pd.year, post.pd.month)
+            self.monthname = post.pd.strftime("%B %Y")
+        self.entries.append(postentry(post))
+
+    def closemonth(self):
+        """Write the page of the current month."""
+
+        if self.month is None:
+            return
+        entries = self.entries
+        self.entries = []
+        relpath = "{:04d}/{:02d}.html".format(*self.month)
+        self.months.append((relpath, self.monthname,
+                            [(e.title, e.uri, e.date) for e in entries]))
+        if not needs_build(relpath, self.monthname, [e.inputs for e in entries]):
+            return
+        page = pageheader("{} &ndash; {}".format(blog_conf["blog"]["title"],
+                                                 self.monthname))
+        page.append("<h2>{}</h2>\n".format(self.monthname))
+        for e in entries:
+            page.extend(entryhtml(e, "../"))
+        page.append(footer)
+        output.write(relpath, page)
+
+    def closeyear(self):
+        """Write the page of the current year."""
+
+        if self.year is None:
+            return
+        months = self.months
+        self.months = []
+        self.years.append((self.year, [(d, name, len(posts)) for d, name, posts in months]))
+        relpath = "{:04d}/index.html".format(self.year)
+        if not needs_build(relpath, months):
+            return
+        page = pageheader("{} &ndash; {}".format(blog_conf["blog"]["title"],
+                                                 self.year))
+        page.append("<h2>{}</h2>".format(self.year))
+        archive_post = templates["archive_post"]
+        for monthpath, name, posts in months:
+            # Links are relative to the year directory
+            page.append("<h3><a href=\"{}\">{}</a></h3>\n<ul>".format(
+                monthpath[5:], name))
+            for title, uri, date in posts:
+                page.extend(archive_post.fill(uri=uri[5:], title=title, date=date))
+            page.append("</ul>\n")
+        page.append(footer)
+        output.write(relpath, page)
+
+    def close(self):
+        self.closemonth()
+        self.closeyear()
+        archive_index = blog_conf.get("files", "archive_index", fallback="all_posts.html")
+        if not needs_build(archive_index, self.years):
+            return
+        archive_title = blog_conf["blog"]["title"] + \
+                        " &ndash; " + \
+                        blog_conf["template"]["archive_title"]
+        page = pageheader(archive_title)
+        page.append("<h2>{}</h2>".format(blog_conf["template"]["archive_title"]))
+        for year, months in self.years:
+            page.append("<h3><a href=\"{0:04d}/index.html\">{0}</a></h3>\n<ul>".format(year))
+            page.extend("<li><a href=\"%s\">%s</a> &mdash; %d %s</li>" %
+                        (monthpath, name, count,
+                         blog_conf.get("template", "tags_posts", fallback="posts"))
+                        for monthpath, name, count in months)
+            page.append("</ul>\n")
+        page.append(footer)
+        output.write(archive_index, page)
+
+
+class TagIndexPage(Sink):
     """Make alphabetical list of all tags."""
 
-    global header
-    makedirs(blog_conf["files"]["blog_dir"], exist_ok=True)
-    tag_index = blog_conf.get("files", "tags_index", fallback="all_tags.html")
-    f = open(path.join(blog_conf["files"]["blog_dir"], tag_index), 'w', encoding="utf-8")
-    # Customize header
-    tags_title = blog_conf["blog"]["title"] + \
-                    " &ndash; " + \
-                    blog_conf["template"]["tags_title"]
-    temp_header = header.format(title=tags_title,
-                               url=blog_conf["blog"]["url"],
-                               description=tags_title,
-                               author=blog_conf["author"]["name"],
-                               locale=locale.getlocale()[0])
-    f.write(temp_header)
-    f.write("<h2>{}</h2>".format(blog_conf["template"]["tags_title"]))
-    f.write("<ul>")
-    cur.execute("SELECT text, COUNT(tags_ref.tag_id) as count "
-                "FROM tags, tags_ref "
-                "WHERE tags.tag_id = tags_ref.tag_id "
-                "GROUP BY tags_ref.tag_id ORDER BY text ASC")
-    with click.progressbar(cur, label="Making all_tags.html", width=0) as tags:
-        for row in tags:
-            f.write("<li><a href=\"tag/%s.html\">%s</a>"
-                    " &mdash; %d %s" % (row["text"], row["text"], row["count"],
-                                        blog_conf.get("template", "tags_posts", fallback="posts")))
-    f.write("</ul>")
-    f.close()
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, post: Post):
+        for tag in post.tags:
+            self.counts[tag] = self.counts.get(tag, 0) + 1
+
+    def close(self):
+        tag_index = blog_conf.get("files", "tags_index", fallback="all_tags.html")
+        rows = sorted(self.counts.items())
+        if not needs_build(tag_index, rows):
+            return
+        tags_title = blog_conf["blog"]["title"] + \
+                        " &ndash; " + \
+                        blog_conf["template"]["tags_title"]
+        f = pageheader(tags_title)
+        f.append("<h2>{}</h2>".format(blog_conf["template"]["tags_title"]))
+        f.append("<ul>")
+        tag_count = templates["tag_count"]
+        for tag, count in rows:
+            f.extend(tag_count.fill(tag=tag, count=count))
+        f.append("</ul>")
+        output.write(tag_index, f)
+
+
+class TagPageWriter:
+    """Write tag pages one at a time from entries ordered by tag.
+
+    Only the entries of the current tag are kept in memory. With spill=True
+    the entries may come in any order: they are spilled to a database file
+    next to the blog's database and read back ordered by tag when the
+    writer is closed. The file is on disk whatever temp_store says, so the
+    memory used does not grow with the blog. Spilled entries keep just the
+    summary of their rendered content, which is all a tag page shows."""
+
+    spill_batch = 1000
+    """Number of entries buffered before they are spilled."""
+
+    def __init__(self, spill: bool = False):
+        self.spill = spill
+        self.tag = None
+        self.entries = []
+        if spill:
+            import os
+            import tempfile
+
+            self.seq = 0
+            self.buffer = []
+            fd, self.spillfile = tempfile.mkstemp(
+                prefix=".tag_spill-", suffix=".db", dir=path.dirname(path.abspath(db_file)))
+            os.close(fd)
+            conn.execute("ATTACH DATABASE ? AS tag_spill", (self.spillfile,))
+            conn.execute("PRAGMA tag_spill.journal_mode = off")
+            conn.execute("PRAGMA tag_spill.synchronous = off")
+            conn.execute("CREATE TABLE tag_spill.entries ("
+                         "tag TEXT NOT NULL, seq INTEGER NOT NULL, "
+                         "post_id INTEGER, title TEXT, uri TEXT, publish_date TEXT, "
+                         "date TEXT, tags TEXT, inputs TEXT, summary TEXT, "
+                         "is_summary INTEGER, PRIMARY KEY (tag, seq)) WITHOUT ROWID")
+
+    def add(self, tag: str, entry: Entry):
+        if self.spill:
+            self.seq += 1
+            self.buffer.append((tag, self.seq) + entry[:5] +
+                               ("\x1f".join(entry.tags), entry.inputs,
+                                entry.rendered.summary, entry.rendered.is_summary))
+            if len(self.buffer) >= self.spill_batch:
+                self.flushspill()
+            return
+        if tag != self.tag:
+            self.writepage()
+            self.tag = tag
+        self.entries.append(entry)
+
+    def flushspill(self):
+        conn.executemany("INSERT INTO tag_spill.entries VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.buffer)
+        self.buffer = []
+
+    def close(self):
+        if self.spill:
+            import os
+
+            self.flushspill()
+            self.spill = False
+            # Read back in primary key order, without sorting
+            for row in conn.execute("SELECT * FROM tag_spill.entries ORDER BY tag, seq"):
+                self.add(row[0], Entry(*row[2:7], row[7].split("\x1f"), row[8],
+                                       Rendered("", row[9], bool(row[10]), "")))
+            conn.commit()
+            conn.execute("DETACH DATABASE tag_spill")
+            os.remove(self.spillfile)
+        self.writepage()
+
+    def writepage(self):
+        """Write the page of the current tag."""
+
+        from html import escape
+
+        tag, entries = self.tag, self.entries
+        self.entries = []
+        if tag is None:
+            return
+        tag_title = "{} &ndash; {} '{}'".format(
+            blog_conf["blog"]["title"],
+            blog_conf["template"]["tag_title"],
+            escape(tag))
+        page = pageheader(tag_title)
+        for e in entries:
+            page.extend(entryhtml(e, "../"))
+        page.append(footer)
+        output.write(path.join("tag", tag + ".html"), page)
+
+
+class TagPages(Sink):
+    """Make a page for each tag.
+
+    Posts come newest first rather than ordered by tag, so while they are
+    read only a digest of the posts of each tag is kept. The tag pages
+    whose posts changed are then written one at a time through a
+    TagPageWriter, each from its posts read again from the database, so
+    only the posts of one tag are kept in memory.
+
+    When every tag page is written anyway, on a full or first build, the
+    posts are not read again for each tag but spilled as they come."""
+
+    def __init__(self):
+        self.digests = {}
+        self.spill = only is None and (full_build or not manifest)
+        self.writer = TagPageWriter(spill=True) if self.spill else None
+
+    def add(self, post: Post):
+        if not post.tags:
+            return
+        entry = postentry(post)
+        inputs = entry.inputs.encode("utf-8")
+        for tag in post.tags:
+            h = self.digests.get(tag)
+            if h is None:
+                h = self.digests[tag] = hashlib.sha1()
+            h.update(inputs)
+            if self.spill:
+                self.writer.add(tag, entry)
+
+    def close(self):
+        changed = [tag for tag, h in sorted(self.digests.items())
+                   if needs_build(path.join("tag", tag + ".html"), h.hexdigest())]
+        if self.spill:
+            self.writer.close()
+            return
+        writer = TagPageWriter()
+        for tag in changed:
+            for post in renderposts(tagposts(tag)):
+                writer.add(tag, postentry(post))
+        writer.close()
+
+
+def feeddate(publish_date: str) -> datetime:
+    """Get a publish date as an aware UTC datetime."""
+
+    return datetime.strptime(publish_date, "%Y-%m-%d %H:%M:%S"). \
+        replace(tzinfo=timezone.utc)
+
+
+def rssfeed(title: str, link: str, feedurl: str, entries: list) -> list:
+    """Make an RSS 2.0 feed of the listed posts."""
+
+    from email.utils import format_datetime
+    from html import escape
+
+    base = blog_conf["blog"]["url"].rstrip("/") + "/"
+    feed = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+            "<rss version=\"2.0\" xmlns:atom=\"http://www.w3.org/2005/Atom\">\n"
+            "<channel>\n"
+            "<title>{}</title>\n<link>{}</link>\n<description>{}</description>\n"
+            "<atom:link href=\"{}\" rel=\"self\" type=\"application/rss+xml\" />\n"
+            .format(escape(title), escape(link),
+                    escape(blog_conf["blog"]["description"]), escape(feedurl))]
+    if entries:
+        # The newest post, not the time of the build, so that an unchanged
+        # feed stays byte for byte the same
+        feed.append("<lastBuildDate>{}</lastBuildDate>\n".format(
+            format_datetime(feeddate(entries[0].publish_date))))
+    for e in entries:
+        url = base + e.uri
+        feed.append("<item>\n<title>{}</title>\n<link>{}</link>\n"
+                    "<guid isPermaLink=\"true\">{}</guid>\n"
+                    "<pubDate>{}</pubDate>\n"
+                    "<description>{}</description>\n</item>\n"
+                    .format(escape(e.title), escape(url), escape(url),
+                            format_datetime(feeddate(e.publish_date)),
+                            escape(e.rendered.html)))
+    feed.append("</channel>\n</rss>\n")
+    return feed
+
+
+def atomfeed(title: str, link: str, feedurl: str, entries: list) -> list:
+    """Make an Atom feed of the listed posts."""
+
+    from html import escape
+
+    base = blog_conf["blog"]["url"].rstrip("/") + "/"
+    updated = feeddate(entries[0].publish_date if entries else "1970-01-01 00:00:00")
+    feed = ["<?xml version=\"1.0\" encoding=\"utf-8\"?>\n"
+            "<feed xmlns=\"http://www.w3.org/2005/Atom\">\n"
+            "<title>{}</title>\n<subtitle>{}</subtitle>\n"
+            "<link href=\"{}\" />\n<link href=\"{}\" rel=\"self\" />\n"
+            "<id>{}</id>\n<updated>{}</updated>\n"
+            "<author><name>{}</name></author>\n"
+            .format(escape(title), escape(blog_conf["blog"]["description"]),
+                    escape(link), escape(feedurl), escape(feedurl),
+                    updated.isoformat(), escape(blog_conf["author"]["name"]))]
+    for e in entries:
+        url = base + e.uri
+        feed.append("<entry>\n<title>{}</title>\n<link href=\"{}\" />\n"
+                    "<id>{}</id>\n<updated>{}</updated>\n"
+                    "<content type=\"html\">{}</content>\n</entry>\n"
+                    .format(escape(e.title), escape(url), escape(url),
+                            feeddate(e.publish_date).isoformat(),
+                            escape(e.rendered.html)))
+    feed.append("</feed>\n")
+    return feed
+
+
+class Feeds(Sink):
+    """Make the RSS and Atom feeds of the blog and of each tag with the
+    newest number_of_feed_articles posts. A tag's feeds are tag/<tag> with
+    the suffixes of the blog's feeds, and there are only those of them that
+    the blog has.
+
+    The feed content comes from the render cache. A feed is only rewritten
+    when its posts or their content change, so it keeps its ETag and
+    Last-Modified for polling clients."""
+
+    def __init__(self):
+        self.length = blog_conf.getint("files", "number_of_feed_articles", fallback=10)
+        self.tagfeeds = blog_conf.getboolean("files", "tag_feeds", fallback=True)
+        self.entries = []
+        self.tags = {}
+
+    def add(self, post: Post):
+        if len(self.entries) < self.length:
+            self.entries.append(postentry(post))
+        if self.tagfeeds:
+            for tag in post.tags:
+                entries = self.tags.setdefault(tag, [])
+                if len(entries) < self.length:
+                    entries.append(postentry(post))
+
+    def close(self):
+        base = blog_conf["blog"]["url"].rstrip("/") + "/"
+        feeds = feedfiles()
+        self.writefeeds(feeds, blog_conf["blog"]["title"], base, self.entries)
+        for tag, entries in sorted(self.tags.items()):
+            self.writefeeds([("tag/" + tag + path.splitext(f)[1], t) for f, t in feeds],
+                            "{} &ndash; {} '{}'".format(
+                                blog_conf["blog"]["title"],
+                                blog_conf["template"]["tag_title"],
+                                tag),
+                            base + "tag/{}.html".format(tag), entries)
+
+    def writefeeds(self, feeds: list, title: str, link: str, entries: list):
+        from html import unescape
+
+        # Titles are HTML, feeds want plain text
+        title = unescape(title)
+        for feed, feedtype in feeds:
+            if not needs_build(feed, title, [e.inputs for e in entries]):
+                continue
+            feedurl = blog_conf["blog"]["url"].rstrip("/") + "/" + feed
+            if feedtype == "application/atom+xml":
+                output.write(feed, atomfeed(title, link, feedurl, entries))
+            else:
+                output.write(feed, rssfeed(title, link, feedurl, entries))
+
+
+search_js = r"""(function () {
+  "use strict";
+  var input = document.getElementById("q");
+  var results = document.getElementById("results");
+  var cache = {};
+  var meta;
+
+  function load(url) {
+    if (!cache[url]) {
+      cache[url] = fetch(url).then(function (r) { return r.ok ? r.json() : {}; });
+    }
+    return cache[url];
+  }
+
+  // Split a query into words the way the index was tokenized
+  function words(query) {
+    return query.toLowerCase().normalize("NFD").replace(/[\u0300-\u036f]/g, "")
+      .match(/[\p{L}\p{N}]+/gu) || [];
+  }
+
+  // Weight of each post with word; the last word of the query also
+  // matches the words it is a prefix of.
+  function postings(word, isPrefix) {
+    var shard = "words/" + encodeURIComponent(word.slice(0, meta.prefix)) + ".json";
+    return load(shard).then(function (index) {
+      var weights = {};
+      Object.keys(index).forEach(function (w) {
+        if (w === word || (isPrefix && word.length >= meta.prefix &&
+                           w.lastIndexOf(word, 0) === 0)) {
+          index[w].forEach(function (p) {
+            weights[p[0]] = (weights[p[0]] || 0) + p[1];
+          });
+        }
+      });
+      return weights;
+    });
+  }
+
+  function escape(text) {
+    return text.replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;");
+  }
+
+  function show(ids, posts) {
+    if (!ids.length) {
+      results.innerHTML = "<p>" + results.getAttribute("data-none") + "</p>";
+      return;
+    }
+    results.innerHTML = "<ul>" + ids.map(function (id) {
+      var p = posts[Math.floor(id / meta.shard)][id];
+      return "<li><a href=\"../" + p[1] + "\">" + escape(p[0]) + "</a> &mdash; " +
+        p[2] + "</li>";
+    }).join("") + "</ul>";
+  }
+
+  function search(query) {
+    var ws = words(query);
+    if (!ws.length) {
+      return;
+    }
+    load("meta.json").then(function (m) {
+      meta = m;
+      return Promise.all(ws.map(function (w, i) {
+        return postings(w, i === ws.length - 1);
+      }));
+    }).then(function (lists) {
+      var scores = {};
+      Object.keys(lists[0]).forEach(function (id) {
+        var score = 0;
+        for (var i = 0; i < lists.length; i++) {
+          if (!(id in lists[i])) {
+            return;
+          }
+          score += lists[i][id] * Math.log(1 + meta.posts / Object.keys(lists[i]).length);
+        }
+        scores[id] = score;
+      });
+      var ids = Object.keys(scores).sort(function (a, b) {
+        return scores[b] - scores[a] || b - a;
+      }).slice(0, 50);
+      var shards = ids.map(function (id) { return Math.floor(id / meta.shard); })
+        .filter(function (s, i, all) { return all.indexOf(s) === i; });
+      return Promise.all(shards.map(function (s) {
+        return load("posts/" + s + ".json").then(function (posts) { return [s, posts]; });
+      })).then(function (loaded) {
+        var posts = {};
+        loaded.forEach(function (l) { posts[l[0]] = l[1]; });
+        show(ids.map(Number), posts);
+      });
+    });
+  }
+
+  var query = new URLSearchParams(window.location.search).get("q");
+  if (query) {
+    input.value = query;
+    search(query);
+  }
+})();
+"""
+"""Script of the search page. It loads only the word shards of the query's
+words and the post shards of the results."""
+
+
+class SearchIndex(Sink):
+    """Make the static search index and the search page that uses it, in
+    the search_index directory:
+
+    - words/<prefix>.json: the posts each word appears in with a weight,
+      partitioned by the first prefix_len characters of the words
+    - posts/<n>.json: title, URI and date of the posts, posts_per_shard
+      posts per file by post ID
+    - meta.json: the number of posts and the partitioning
+
+    The words are read from the full-text index. Only the shards of the
+    posts that changed since the last build are made again: the post
+    shards they are in and the word shards of the prefixes of their words,
+    before and after the change, which are kept in the search_posts table."""
+
+    prefix_len = 2
+    posts_per_shard = 1000
+    title_weight = 10
+    """How many times a word in the title counts."""
+    tokenize = "unicode61 remove_diacritics 2"
+    """Tokenizer of the full-text index posts_fts."""
+    batch = 1000
+    """Number of posts tokenized at a time to find the prefixes of their words."""
+
+    def __init__(self):
+        self.dir = searchdir()
+        self.posts = {}
+        self.digests = {}
+
+    def add(self, post: Post):
+        e = postentry(post)
+        self.posts[post.post_id] = [post.title, post.uri, e.date]
+        self.digests[post.post_id] = digest(base_digest, e.inputs)
+
+    def close(self):
+        meta = self.dump({"posts": len(self.posts), "prefix": self.prefix_len,
+                          "shard": self.posts_per_shard})
+        metapath = self.dir + "/meta.json"
+        # Without the previous index, or when making a file on demand, all
+        # of it is made
+        full = full_build or only is not None or metapath not in manifest
+        if needs_build(metapath, meta):
+            output.write(metapath, [meta])
+        self.writepage()
+        stored = {} if full else dict(conn.execute("SELECT post_id, digest FROM search_posts"))
+        if not stored:
+            full = True
+        changed = [i for i, d in self.digests.items() if stored.get(i) != d]
+        removed = [i for i in stored if i not in self.digests]
+        if len(changed) + len(removed) > len(self.digests) // 2:
+            # Reading the whole vocabulary at once is faster then
+            full = True
+
+        if full:
+            prefixes = None
+            post_shards = {i // self.posts_per_shard for i in self.posts}
+        else:
+            prefixes = set()
+            for ids in self.batches(changed + removed):
+                for (words,) in conn.execute(
+                        "SELECT prefixes FROM search_posts WHERE post_id IN "
+                        "(SELECT value FROM json_each(?))", (self.dump(ids),)):
+                    prefixes.update(words.split())
+            post_shards = {i // self.posts_per_shard for i in changed + removed}
+        if only is None:
+            # The prefixes of the words of the changed posts as they are now
+            new = self.termprefixes(list(self.digests) if full else changed)
+            if not full:
+                for words in new.values():
+                    prefixes.update(words.split())
+            self.store(full, new, removed)
+
+        for number in sorted(post_shards):
+            start = number * self.posts_per_shard
+            posts = {i: self.posts[i] for i in range(start, start + self.posts_per_shard)
+                     if i in self.posts}
+            if posts:
+                self.writeshard("posts/{}.json".format(number), posts)
+        if full:
+            rows = conn.execute("SELECT term, doc, sum(col = 'title'), count(*) "
+                                "FROM posts_fts_words GROUP BY term, doc ORDER BY term, doc")
+            for prefix, terms in groupby(rows, key=lambda r: r[0][:self.prefix_len]):
+                self.writewords(prefix, terms)
+            return
+        for prefix in sorted(prefixes):
+            self.writewords(prefix, self.terms(prefix))
+        # Keep the other shards of the previous build
+        rewritten = {self.dir + "/posts/{}.json".format(n) for n in post_shards}
+        rewritten.update(self.dir + "/words/{}.json".format(p) for p in prefixes)
+        for p, d in manifest.items():
+            if p.startswith(self.dir + "/") and p not in built and p not in rewritten:
+                built[p] = d
+
+    def batches(self, post_ids: list):
+        """Split post IDs into lists of at most batch."""
+
+        for i in range(0, len(post_ids), self.batch):
+            yield post_ids[i:i + self.batch]
+
+    def termprefixes(self, post_ids: list) -> dict:
+        """Get the prefixes of the words of posts, space separated, by post ID.
+
+        The posts are tokenized like the full-text index, in a temporary
+        full-text index of a batch of posts at a time."""
+
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.search_terms "
+                     "USING fts5(title, content, tokenize='{}')".format(self.tokenize))
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.search_terms_words "
+                     "USING fts5vocab(temp, search_terms, instance)")
+        prefixes = {}
+        for ids in self.batches(post_ids):
+            conn.execute("INSERT INTO temp.search_terms (rowid, title, content) "
+                         "SELECT post_id, title, content FROM posts "
+                         "WHERE post_id IN (SELECT value FROM json_each(?))",
+                         (self.dump(ids),))
+            prefixes.update(conn.execute(
+                "SELECT doc, group_concat(prefix, ' ') FROM "
+                "(SELECT DISTINCT doc, substr(term, 1, ?) AS prefix "
+                " FROM temp.search_terms_words) GROUP BY doc", (self.prefix_len,)))
+            conn.execute("DELETE FROM temp.search_terms")
+        return prefixes
+
+    def store(self, full: bool, prefixes: dict, removed: list):
+        """Store the posts of this build's index in search_posts."""
+
+        with conn:
+            if full:
+                conn.execute("DELETE FROM search_posts")
+            conn.executemany("DELETE FROM search_posts WHERE post_id = ?",
+                             ((i,) for i in removed))
+            conn.executemany("INSERT OR REPLACE INTO search_posts (post_id, digest, prefixes) "
+                             "VALUES (?, ?, ?)",
+                             ((i, self.digests[i], prefixes.get(i, ""))
+                              for i in self.digests if full or i in prefixes))
+
+    def terms(self, prefix: str):
+        """Read the words starting with prefix from the full-text index, with
+        the posts they appear in."""
+
+        if len(prefix) < self.prefix_len:
+            # Only the word itself has a prefix this short
+            where, params = "term = ?", (prefix,)
+        else:
+            end = ord(prefix[-1]) + 1
+            if 0xD800 <= end < 0xE000:
+                end = 0xE000
+            where, params = "term >= ? AND term < ?", (prefix, prefix[:-1] + chr(end))
+        return conn.execute("SELECT term, doc, sum(col = 'title'), count(*) "
+                            "FROM posts_fts_words WHERE " + where +
+                            " GROUP BY term, doc ORDER BY term, doc", params)
+
+    def writewords(self, prefix: str, terms):
+        """Write the word shard of prefix from the rows of its words."""
+
+        words = {}
+        for term, post_id, in_title, count in terms:
+            if post_id in self.posts:
+                words.setdefault(term, []).append(
+                    [post_id, count + (self.title_weight - 1) * in_title])
+        if words:
+            self.writeshard("words/{}.json".format(prefix), words)
+
+    @staticmethod
+    def dump(obj) -> str:
+        import json
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"),
+                          sort_keys=True)
+
+    def writeshard(self, name: str, obj):
+        relpath = self.dir + "/" + name
+        data = self.dump(obj)
+        if needs_build(relpath, data):
+            output.write(relpath, [data])
+
+    def writepage(self):
+        search = blog_conf.get("template", "search", fallback="Search")
+        page = pageheader("{} &ndash; {}".format(blog_conf["blog"]["title"], search))
+        page += ["<h2>{}</h2>\n".format(search),
+                "<form action=\"index.html\"><p>"
+                "<input type=\"search\" name=\"q\" id=\"q\" /> "
+                "<input type=\"submit\" value=\"{}\" /></p></form>\n".format(search),
+                "<div id=\"results\" data-none=\"{}\"></div>\n".format(
+                    blog_conf.get("template", "search_none", fallback="No posts found.")),
+                "<script type=\"text/javascript\" src=\"search.js\"></script>\n",
+                footer]
+        if needs_build(self.dir + "/index.html"):
+            output.write(self.dir + "/index.html", page)
+        if needs_build(self.dir + "/search.js", search_js):
+            output.write(self.dir + "/search.js", [search_js])
+
+
+def pagesource(relpath: str):
+    """Get what makes a generated file on demand: a list of page generators
+    and the posts to feed them, as few as the file needs.
+
+    Returns None if relpath is not a generated file."""
+
+    index_file = blog_conf.get("files", "index_file", fallback="index.html")
+    m = re.fullmatch(r"page/(\d+)\.html", relpath)
+    if relpath == index_file or m:
+        count = postcount()
+        if not m:
+            return [IndexPages(count)], scanposts(limit=index_len)
+        number = int(m.group(1))
+        key = indexkey(number, count)
+        if key is None:
+            return None
+        return [IndexPages(count, max(0, count - number * index_len))], scanposts(
+            "(publish_date, post_id) <= (?, ?)", key, limit=index_len)
+    m = re.fullmatch(r"(\d{4})/(index|\d{2})\.html", relpath)
+    if m:
+        prefix = m.group(1) + ("" if m.group(2) == "index" else "-" + m.group(2))
+        return [ArchivePages()], scanposts("publish_date LIKE ?", (prefix + "-%",))
+    m = re.fullmatch(r"(\d{4})/(\d{2})/([^/]+)", relpath)
+    if m:
+        return [PostPages()], scanposts("filename = ? AND publish_date LIKE ?",
+                                        (m.group(3), m.group(1) + "-" + m.group(2) + "-%"))
+    suffixes = [".html"] + [path.splitext(f)[1] for f, t in feedfiles()]
+    m = re.fullmatch(r"tag/(.+?)(" + "|".join(map(re.escape, suffixes)) + ")", relpath)
+    if m:
+        return [TagPages(), Feeds()], tagposts(m.group(1))
+    full = [blog_conf.get("files", "archive_index", fallback="all_posts.html"),
+            blog_conf.get("files", "tags_index", fallback="all_tags.html")]
+    full.extend(f for f, t in feedfiles())
+    if relpath in full:
+        return [ArchivePages(), TagIndexPage(), Feeds()], scanposts()
+    if searchdir() and relpath.startswith(searchdir() + "/"):
+        return [SearchIndex()], scanposts()
+    return None
+
+
+def makepage(relpath: str):
+    """Make a generated file on demand, in memory. Returns its content, or
+    None if relpath is not a generated file."""
+
+    global output, only, new_renders
+    source = pagesource(relpath)
+    if source is None:
+        return None
+    sinks, posts = source
+    output, only = MemoryOutput(), relpath
+    try:
+        build(sinks, posts)
+    finally:
+        only = None
+        # Nothing is stored. Renders stay in render_cache: storing them would
+        # look like a change to the database and empty the page cache.
+        conn.rollback()
+        new_renders = []
+    return output.files.get(relpath)
+
+
+def writeposts(jobs: int = 1):
+    """Write posts to files."""
+    build([PostPages()], jobs=jobs)
+
+
+def makeindex():
+    """Make the main index.html and the pages of older posts."""
+    build([IndexPages()])
+
+
+def makefullidx():
+    """Make the archive pages and the archive index."""
+    build([ArchivePages()])
 
 
 def maketagpages():
     """Make a page for each tag."""
+    build([TagPages()])
 
-    global header
-    tagdir = path.join(blog_conf["files"]["blog_dir"], "tag")
-    makedirs(tagdir, exist_ok=True)
-    tagfiles = {}
-    cur.execute("SELECT tags.text AS tag, posts.title AS title, "
-                "posts.filename AS fn, posts.publish_date AS pd, "
-                "posts.content AS content, "
-                "posts.post_id AS post_id "
-                "FROM posts, tags, tags_ref "
-                "WHERE tags_ref.post_id = posts.post_id "
-                "AND tags_ref.tag_id = tags.tag_id "
-                "ORDER BY tags.text ASC, posts.publish_date DESC")
-    with click.progressbar(cur, label="Making tag/*.html", width=0) as tags:
-        for row in tags:
-            tagpath = path.join(tagdir, row["tag"] + ".html")
-            if tagpath not in tagfiles.keys():
-                tagfiles[tagpath] = open(tagpath, 'w', encoding="utf-8")
-                # Customize header
-                tag_title = "{} &ndash; {} '{}'".format(
-                    blog_conf["blog"]["title"],
-                    blog_conf["template"]["tag_title"],
-                    row["tag"])
-                temp_header = header.format(title=tag_title,
-                               url=blog_conf["blog"]["url"],
-                               description=tag_title,
-                               author=blog_conf["author"]["name"],
-                               locale=locale.getlocale()[0])
-                tagfiles[tagpath].write(temp_header)
-            postpath = "../" + geturi(row["fn"], row["pd"])
-            pdstring = pubdate2str(row["pd"], blog_conf["template"]["date_format"])
-            has_summary, summary = getsummary(row["content"])
-            tagfiles[tagpath].write("<h3><a href=\"{outfile}\">{title}</a></h3>\n"
-                                    "<p>{publish_date}</p>\n{summary}\n"
-                                    .format(outfile=postpath,
-                                            publish_date=pdstring,
-                                            title=row["title"],
-                                            summary=summary))
-            if has_summary:
-                tagfiles[tagpath].write("<p><a href=\"{}\">Read more...</a></p>\n"
-                                        .format(postpath))
-
-            tagfiles[tagpath].write("<p class=\"tagsline\">{} {}</p>\n".
-                                    format(blog_conf["template"]["tags_line_header"],
-                                           gettagsline(row["post_id"], "../")))
-    for f in tagfiles.values():
-        f.write(footer)
-        f.close()
 
+def maketagindex():
+    """Make alphabetical list of all tags."""
+    build([TagIndexPage()])
 
-def db_tagpost(tags: list, post_id: int):
-    """Make DB tag entries for a post."""
-    # Delete all tag-post relations for this post. Needed for updates.
-    cur.execute("DELETE FROM tags_ref WHERE post_id = ?", (post_id,))
-    for tag in tags:
-        # Check if a tag with this text already exists
-        cur.execute("SELECT tag_id FROM tags WHERE text = ?", (tag,))
-        try:
-            tag_id = cur.fetchone()[0]
-        # If not, insert it
-        except TypeError:  # fetchone() returns None if no more rows
-            cur.execute("INSERT INTO tags (text) VALUES (?)", (tag,))
-            tag_id = cur.lastrowid
-        # Insert a relation tag <-> post
-        cur.execute("INSERT INTO tags_ref (tag_id, post_id) VALUES (?, ?)",
-                    (tag_id, post_id))
 
+def makefeeds():
+    """Make the RSS and Atom feeds."""
+    build([Feeds()])
 
-def db_rm_orphan_tags():
-    """Delete orphan tags, i.e. ones not referenced by any post."""
-    cur.execute("DELETE FROM tags"
-                "WHERE NOT EXISTS(SELECT 1 FROM tags_ref WHERE tags_ref.tag_id = tags.tag_id)")
+
+def db_tagpost(tags: list, post_id: int):
+    """Make DB tag entries for a post.
+
+    The new tags are compared with the post's current ones and only the
+    relations that changed are added or removed. This is committed in one
+    transaction together with any pending changes to the post itself."""
+
+    tags = [t for t in dict.fromkeys(tags) if t]
+    current = dict(conn.execute("SELECT tags.text, tags.tag_id FROM tags_ref, tags "
+                                "WHERE tags.tag_id = tags_ref.tag_id "
+                                "AND tags_ref.post_id = ?", (post_id,)))
+    added = [t for t in tags if t not in current]
+    removed = [(post_id, tag_id) for t, tag_id in current.items() if t not in tags]
+    with conn:
+        cur.executemany("INSERT OR IGNORE INTO tags (text) VALUES (?)",
+                        ((t,) for t in added))
+        cur.executemany("INSERT INTO tags_ref (tag_id, post_id) "
+                        "SELECT tag_id, ? FROM tags WHERE text = ?",
+                        ((post_id, t) for t in added))
+        cur.executemany("DELETE FROM tags_ref WHERE post_id = ? AND tag_id = ?",
+                        removed)
+        db_rm_orphan_tags([tag_id for p, tag_id in removed])
+
+
+def db_rm_orphan_tags(tag_ids: list = None):
+    """Delete orphan tags, i.e. ones not referenced by any post.
+
+    If tag_ids is given, only those tags are checked."""
+    query = ("DELETE FROM tags "
+             "WHERE NOT EXISTS(SELECT 1 FROM tags_ref WHERE tags_ref.tag_id = tags.tag_id)")
+    if tag_ids is None:
+        cur.execute(query)
+    else:
+        cur.executemany(query + " AND tag_id = ?", ((i,) for i in tag_ids))
 
 
 def set_post_hidden(id_: int, hidden: bool):
     """Set the hidden status of a post."""
-    cur.execute("UPDATE posts SET hidden = ? WHERE id = ?", (hidden, id_))
+    cur.execute("UPDATE posts SET hidden = ? WHERE post_id = ?", (hidden, id_))
+    if cur.rowcount == 0:
+        raise click.BadParameter("No posts found.", param_hint="ID")
+    queuerebuild([id_])
     conn.commit()
 
 
+def queuerebuild(post_ids):
+    """Queue changed posts for the next rebuild, in the current transaction.
+    A post queued again is queued as of now."""
+
+    now = time()
+    conn.executemany("INSERT OR REPLACE INTO rebuild_queue (post_id, queued_at) "
+                     "VALUES (?, ?)", ((post_id, now) for post_id in post_ids))
+
+
+def rebuildqueue() -> list:
+    """Get the queued changes as (post_id, queued_at) rows."""
+
+    return conn.execute("SELECT post_id, queued_at FROM rebuild_queue").fetchall()
+
+
+def loadconfig():
+    """Read the config file."""
+
+    global blog_conf
+    blog_conf = configparser.ConfigParser()
+    blog_conf.read(config_file, encoding="utf-8")
+    if not "date_format" in blog_conf["template"]:
+        blog_conf["template"]["date_format"] = "%%B %%d, %%Y"
+    global index_len
+    index_len = blog_conf.getint("files", "number_of_index_articles", fallback=8)
+
+    if not "blog_dir" in blog_conf["files"]:
+        blog_conf["files"]["blog_dir"] = "."
+    if not "css_include" in blog_conf["files"]:
+        blog_conf["files"]["css_include"] = ""
+    if not "tags_line_header" in blog_conf["template"]:
+        blog_conf["template"]["tags_line_header"] = "Tags"
+
+    blog_conf["template"]["archive_title"] = \
+        blog_conf.get("template", "archive_title", fallback="All posts")
+    blog_conf["template"]["tags_title"] = \
+        blog_conf.get("template", "tags_title", fallback="All tags")
+
+    author_conf = {"url": blog_conf.get("author", "url", fallback="http://www.example.com/"),
+                   "email": blog_conf.get("author", "email", fallback="nobody@example.com").\
+                            replace("@", "&#64;"),
+                   "name": blog_conf.get("author", "name", fallback="nobody")}
+    blog_conf["author"] = author_conf
+
+    blog_c = {"title": blog_conf.get("blog", "title", fallback="Blog"),
+              "url": blog_conf.get("blog", "url", fallback=""),
+              "description": blog_conf.get("blog", "description", fallback="Blog description")}
+    blog_conf["blog"] = blog_c
+
+
+def loadtemplates():
+    """Set the date locale, read or make the header and footer and compile
+    the page templates, for the commands that make pages."""
+
+    locale.setlocale(locale.LC_ALL, blog_conf.get("template", "date_locale", fallback="C"))
+    header_file = blog_conf.get("files", "header_file", fallback=None)
+    footer_file = blog_conf.get("files", "footer_file", fallback=None)
+
+    global header, footer
+    if header_file:
+        with open(header_file, "r", encoding="utf-8") as hf:
+            header = hf.read()
+    else:
+        header = makeheader()
+
+    if footer_file:
+        with open(footer_file, "r", encoding="utf-8") as ff:
+            footer = ff.read()
+    else:
+        footer = makefooter()
+    footer = footer.format(all_posts=blog_conf["template"]["archive_title"],
+                           all_tags=blog_conf["template"]["tags_title"],
+                           author_url=blog_conf["author"]["url"],
+                           author_email=blog_conf["author"]["email"],
+                           author_name=blog_conf["author"]["name"],
+                           search=blog_conf.get("template", "search", fallback="Search"))
+    compiletemplates()
+
+
 # Click stuff
 
 
@@ -393,80 +2261,63 @@ def cli(config):
         config_file = config
     else:
         config_file = "config.ini"
+    # The config and database are read by the commands that use them
+    loaded.clear()
 
-    if path.isfile(config_file):
-        # Reading config from INI file
-        global blog_conf
-        blog_conf = configparser.ConfigParser()
-        blog_conf.read(config_file, encoding="utf-8")
-        date_locale = blog_conf.get("template", "date_locale", fallback="C")
-        locale.setlocale(locale.LC_ALL, date_locale)
-        if not "date_format" in blog_conf["template"]:
-            blog_conf["template"]["date_format"] = "%%B %%d, %%Y"
-        global index_len
-        index_len = blog_conf.getint("files", "number_of_index_articles", fallback=8)
-
-        if not "blog_dir" in blog_conf["files"]:
-            blog_conf["files"]["blog_dir"] = "."
-        if not "css_include" in blog_conf["files"]:
-            blog_conf["files"]["css_include"] = ""
-        if not "tags_line_header" in blog_conf["template"]:
-            blog_conf["template"]["tags_line_header"] = "Tags"
-
-        blog_conf["template"]["archive_title"] = \
-            blog_conf.get("template", "archive_title", fallback="All posts")
-        blog_conf["template"]["tags_title"] = \
-            blog_conf.get("template", "tags_title", fallback="All tags")
-
-        author_conf = {"url": blog_conf.get("author", "url", fallback="http://www.example.com/"),
-                       "email": blog_conf.get("author", "email", fallback="nobody@example.com").\
-                                replace("@", "&#64;"),
-                       "name": blog_conf.get("author", "name", fallback="nobody")}
-        blog_conf["author"] = author_conf
-
-        header_file = blog_conf.get("files", "header_file", fallback=None)
-        footer_file = blog_conf.get("files", "footer_file", fallback=None)
-
-        blog_c = {"title": blog_conf.get("blog", "title", fallback="Blog"),
-                  "url": blog_conf.get("blog", "url", fallback=""),
-                  "description": blog_conf.get("blog", "description", fallback="Blog description")}
-        blog_conf["blog"] = blog_c
-
-        global header, footer
-        if header_file:
-            with open(header_file, "r", encoding="utf-8") as hf:
-                header = hf.read()
-        else:
-            header = makeheader()
 
-        if footer_file:
-            with open(footer_file, "r", encoding="utf-8") as ff:
-                footer = ff.read()
-        else:
-            footer = makefooter()
-        footer = footer.format(all_posts=blog_conf["template"]["archive_title"],
-                               all_tags=blog_conf["template"]["tags_title"],
-                               author_url=blog_conf["author"]["url"],
-                               author_email=blog_conf["author"]["email"],
-                               author_name=blog_conf["author"]["name"])
-        if path.isfile(db_file):
-            try:
-                # Setting up Sqlite connection
-                global conn
-                conn = sqlite3.connect(db_file)
-                global cur
+def opendb():
+    """Open the database, if there is one, and bring its schema up to date."""
 
-                conn.row_factory = sqlite3.Row
-                cur = conn.cursor()
-                cur.execute("PRAGMA foreign_keys=1")
-            except sqlite3.IntegrityError as e:
-                click.echo("SQL error: %s" % e)
+    if path.isfile(db_file):
+        try:
+            # Setting up Sqlite connection
+            global conn
+            conn = connect(db_file)
+            global cur
+
+            conn.row_factory = sqlite3.Row
+            conn.set_trace_callback(countsql)
+            cur = conn.cursor()
+            migrate(conn)
+        except sqlite3.IntegrityError as e:
+            click.echo("SQL error: %s" % e)
+
+
+def uses(*parts):
+    """Decorator for the commands: before the command runs, read the config
+    file and set up the other parts of the program state it uses, "db" for
+    the database connection and "templates" for making pages. Each part is
+    set up once per invocation, so that e.g. `challi --help` or `challi ls`
+    don't pay for what they don't use."""
+
+    def decorator(f):
+        @wraps(f)
+        def command(*args, **kwargs):
+            global blog_conf, conn, cur
+            if "config" not in loaded:
+                loaded.add("config")
+                blog_conf = conn = cur = None
+                if path.isfile(config_file):
+                    loadconfig()
+            if "db" in parts and "db" not in loaded:
+                loaded.add("db")
+                if blog_conf is not None:
+                    opendb()
+            if "db" in parts and conn is None:
+                raise click.UsageError("No database file `%s'" % db_file)
+            if "templates" in parts and "templates" not in loaded and blog_conf is not None:
+                loaded.add("templates")
+                loadtemplates()
+            return f(*args, **kwargs)
+        return command
+    return decorator
 
 
 @click.command()
 @click.argument("directory",
                 required=False,
                 type=click.Path(dir_okay=True, writable=True))
+@uses()
 def init(directory):
     """Initialize a new blog.
 
@@ -484,7 +2335,7 @@ def init(directory):
         exit(1)
 
     click.echo("Initializing empty database in `%s' ..." % init_db)
-    init_conn = sqlite3.connect(init_db)
+    init_conn = connect(init_db)
     init_cur = init_conn.cursor()
     init_sql = """
     BEGIN TRANSACTION;
@@ -536,6 +2387,7 @@ def init(directory):
 
     init_cur.executescript(init_sql)
     init_conn.commit()
+    migrate(init_conn)
     init_conn.close()
 
     default_config = """
@@ -592,9 +2444,20 @@ blog_dir=blog
 # global archive
 archive_index=all_posts.html
 tags_index=all_tags.html
-# feed file (rss in this case)
+# feed files, leave empty to not generate that feed
 blog_feed=feed.rss
+atom_feed=feed.atom
 number_of_feed_articles=10
+# also generate feeds for each tag (tag/<tag> with the suffixes of the feeds above)
+tag_feeds=yes
+# directory of the static search index and search page, leave empty to not
+# generate them
+search_index=search
+# also write precompressed copies (page.html.gz, page.html.br) of the HTML,
+# CSS, feed and search index files for web servers that serve them as is
+# (nginx gzip_static and brotli_static), e.g. precompress=gzip,br
+# br needs the brotli module
+precompress=
 
 # personalized header and footer (only if you know what you're doing)
 # header_file=
@@ -608,13 +2471,28 @@ number_of_feed_articles=10
 # leave empty to use generated
 css_include=blog.css
 
-# Where to upload the blog? Settings for rsync
+# Where to upload the blog? A host and directory to upload to with rsync,
+# or a local directory to copy to
 # rsync_dest=example.com:/var/www/html/blog
 # rsync_user=
 
-# How to invoke rsync?
+# Options to invoke rsync with
 # Make sure you have passwordless SSH key based authentication to the destination!
-rsync_command=rsync -arz --delete --progress %(blog_dir)/* %(rsync_user)@%(rsync_dest)/
+rsync_options=-az
+
+[database]
+# SQLite settings, see https://www.sqlite.org/pragma.html
+# Write-ahead logging lets readers (e.g. a preview server) run during a build
+journal_mode=wal
+synchronous=normal
+# Page cache size, negative values are KiB (default 64 MiB)
+cache_size=-65536
+# Bytes of the database file to memory map (default 256 MiB)
+mmap_size=268435456
+# Where to keep temporary tables and indexes, e.g. for sorting: memory or file
+temp_store=memory
+# Number of prepared statements kept for reuse
+cached_statements=256
 
 [template]
 # Localization and i18n
@@ -624,6 +2502,11 @@ comments=Comments?
 read_more=Read more...
 # "View more posts" (used on bottom of index page as link to archive)
 archive=All posts
+# "Newer posts" and "Older posts" (links between the pages of the index)
+newer_posts=Newer posts
+older_posts=Older posts
+# "Page" (title of the older index pages, like "My Blog - Page 2")
+page=Page
 # "All posts" (title of archive page)
 archive_title=All posts
 # "All tags
@@ -634,6 +2517,10 @@ tags_posts=posts
 tag_title=Posts tagged
 # "Tags:" (beginning of line in HTML file with list of all tags for this article)
 tags_line_header=Tags:
+# "Search" (title of the search page and link to it at the bottom of every page)
+search=Search
+# "No posts found." (shown on the search page when nothing matches)
+search_none=No posts found.
 # "Back to the index page" (used on archive page, it is link to blog index)
 archive_index_page=Back to the index page
 # "Subscribe" (used on bottom of index page, it is link to RSS feed)
@@ -698,8 +2585,11 @@ h4{margin-left:24px;margin-right:24px;}
               help="Make this post hidden (a draft).")
 @click.option('--get-from', '-g', type=click.File('r'),
               help="Read post content (and tags) from file (don't open an editor).")
+@click.option('--no-rebuild', is_flag=True,
+              help="Don't rebuild the blog, queue the change for rebuild --pending.")
 @click.pass_context
-def post(ctx, hidden, get_from):
+@uses("db")
+def post(ctx, hidden, get_from, no_rebuild):
     """Write a new blog post."""
 
     post_template = \
@@ -708,8 +2598,9 @@ def post(ctx, hidden, get_from):
          "{} comma-separated, list, of, tags").format(blog_conf["template"]["tags_line_header"])
 
     query = """INSERT INTO posts
-            (title, content, publish_date, filename, hidden)
-            VALUES (?, ?, ?, ?, ?)"""
+            (title, content, publish_date, filename, hidden,
+             summary_end, description, word_count, reading_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
 
     pd = datetime.strftime(datetime.now(timezone.utc), "%Y-%m-%d %H:%M:%S")
 
@@ -722,79 +2613,158 @@ def post(ctx, hidden, get_from):
         raise click.UsageError("No edits made to template")
 
     title, body, tags = split_input(post_text)
+    slug = makeslug(title)
 
-    fromchars = "äöåøæđðčžš"
-    tochars = "aoaoaddczs"
-    transtable = str.maketrans(fromchars, tochars)
-
-    filename = title.replace(" ", "_").lower()
-    filename = re.sub(r'[^\w\d]', "", filename).strip('_') + ".html"
-    filename = filename.translate(transtable)
-
-    cur.execute(query, (title, body, pd, filename, hidden))
+    cur.execute(query, (title, body, pd, slug + ".html", hidden) + postmeta(body))
     post_id = cur.lastrowid
+    if not slug:
+        # Named after the post ID, known only now
+        cur.execute("UPDATE posts SET filename = ? WHERE post_id = ?",
+                    (postfilename(title, post_id), post_id))
+    queuerebuild([post_id])
 
     db_tagpost(tags, post_id)
-    conn.commit()
-    ctx.invoke(rebuild)
+    if not no_rebuild:
+        ctx.invoke(rebuild)
+
+
+ls_orders = {"id": "post_id", "title": "title", "date": "publish_date"}
+"""Columns that ls can order by, by option value. Each is indexed."""
+
+
+def lsrows(order_by: str, collation: str, limit: int, tags: Tuple,
+           visibility: str):
+    """Query the posts to list, as a cursor that is read as it goes."""
+
+    where, params = [], []
+    if visibility is not None:
+        where.append("hidden = ?")
+        params.append(visibility == "hidden")
+    if tags:
+        where.append("post_id IN (SELECT post_id FROM tags_ref JOIN tags USING (tag_id) "
+                     "WHERE tags.text IN ({}) GROUP BY post_id HAVING count(*) = ?)".
+                     format(", ".join("?" * len(set(tags)))))
+        params += list(set(tags)) + [len(set(tags))]
+    column = ls_orders[order_by]
+    # post_id breaks ties in the same direction, so the index gives the order
+    order = "{0} {1}, post_id {1}".format(column, collation) if column != "post_id" \
+        else "post_id {}".format(collation)
+    query = "SELECT post_id, publish_date, title, hidden, word_count, reading_time " \
+        "FROM posts{} ORDER BY {}".format(
+        " WHERE " + " AND ".join(where) if where else "", order)
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return conn.execute(query, params)
+
+
+def lstable(rows):
+    """Format the posts as a table to read, line by line."""
+
+    from shutil import get_terminal_size
+
+    # Get terminal width
+    tw = get_terminal_size().columns
+    rowstr = "{:>6} | {:>16} | {:>6} | {:<25}\n"
+    # Print a '-' separator with '+' signs at column borders,
+    # fill to terminal width
+    separator = "-" * 6 + "-+-" + "-" * 16 + "-+--------+-"
+    separator += "-" * (tw - len(separator))
+    yield rowstr.format("ID", "Date", "Hidden", "Title")
+    yield separator + "\n"
+    for row in rows:
+        yield rowstr.format(row["post_id"], row["publish_date"][:16],
+                            "✔" if row["hidden"] else " ", row["title"])
+
+
+def lsjson(rows):
+    """Format the posts as a JSON array, one post per line."""
+
+    import json
+
+    sep = "[\n"
+    for row in rows:
+        yield sep + json.dumps({"id": row["post_id"], "date": row["publish_date"],
+                                "hidden": bool(row["hidden"]), "title": row["title"],
+                                "words": row["word_count"],
+                                "reading_time": row["reading_time"]},
+                               ensure_ascii=False)
+        sep = ",\n"
+    yield "[]\n" if sep == "[\n" else "\n]\n"
+
+
+def lstsv(rows):
+    """Format the posts as tab-separated values, with a header line."""
+
+    yield "id\tdate\thidden\ttitle\twords\treading_time\n"
+    for row in rows:
+        yield "{}\t{}\t{}\t{}\t{}\t{}\n".format(
+            row["post_id"], row["publish_date"], row["hidden"],
+            " ".join(row["title"].split()),
+            "" if row["word_count"] is None else row["word_count"],
+            "" if row["reading_time"] is None else row["reading_time"])
 
 
 @click.command(name="ls")
-@click.option('--order-by',
-              type=click.Choice(['id', 'title', 'date']),
+@click.option('--order-by', type=click.Choice(list(ls_orders)), default="date",
               help="Select which field to order by (default=date).")
 @click.option('--asc', 'collation', flag_value='ASC', default=False,
               help="Ascending order.")
 @click.option('--desc', 'collation', flag_value='DESC', default=True,
               help="Descending order (default).")
-def list_posts(order_by, collation):
-    """List all blog posts."""
-
-    # TODO: --order-by and --asc/--desc do nothing right now.
-    # Wasn't working when I tried :(
-
-    # Get terminal width and height
-    tw, th = click.get_terminal_size()
-    rowstr = "{:>6} | {:>16} | {:>6} | {:<25}"
-    # Print a '-' separator with '+' signs at column borders,
-    # fill to terminal width
-    separator = "-" * 6 + "-+-" + "-" * 16 + "-+--------+-"
-    separator += "-" * (tw - len(separator))
-    query = """SELECT post_id, publish_date, title, hidden FROM
-    posts ORDER BY publish_date DESC"""
-    if order_by == "date" or order_by is None:
-        order_by = "publish_date"
-    list_text = rowstr.format("ID", "Date", "Hidden", "Title") + "\n"
-    list_text += separator + "\n"
-    for row in cur.execute(query):  # ,(order_by,)):
-        if row["hidden"]:
-            hidden = "✔"
-        else:
-            hidden = " "
-        date = row["publish_date"][:16]
-        list_text += rowstr.format(row["post_id"], date,
-                                   hidden, row["title"]) + "\n"
-    if list_text.count("\n") + 1 > th:
-        click.echo_via_pager(list_text)
+@click.option('--limit', '-n', type=click.IntRange(min=0),
+              help="List at most this many posts.")
+@click.option('--tag', '-t', 'tags', multiple=True,
+              help="Only list posts with this tag. Can be given more than once.")
+@click.option('--hidden', 'visibility', flag_value='hidden',
+              help="Only list hidden posts.")
+@click.option('--visible', 'visibility', flag_value='visible',
+              help="Only list posts that are not hidden.")
+@click.option('--format', 'format_', type=click.Choice(['table', 'json', 'tsv']),
+              default='table', help="Output format (default=table).")
+@uses("db")
+def list_posts(order_by, collation, limit, tags, visibility, format_):
+    """List all blog posts.
+
+    The posts are written out as they are read from the database. A table
+    longer than the terminal goes through a pager."""
+    from itertools import chain, islice
+    from shutil import get_terminal_size
+
+    rows = lsrows(order_by, collation, limit, tags, visibility)
+    if format_ != "table":
+        for line in (lsjson if format_ == "json" else lstsv)(rows):
+            click.echo(line, nl=False)
+        return
+    lines = lstable(rows)
+    # Only read enough to know whether the table fits on the terminal
+    th = get_terminal_size().lines
+    head = list(islice(lines, th - 1))
+    if len(head) < th - 1:
+        click.echo("".join(head), nl=False)
     else:
-        click.echo(list_text)
+        click.echo_via_pager(chain(head, lines))
 
 
 @click.command()
 @click.argument('id_', type=click.INT, metavar='ID')
+@click.option('--no-rebuild', is_flag=True,
+              help="Don't rebuild the blog, queue the change for rebuild --pending.")
 @click.pass_context
-def edit(ctx, id_):
+@uses("db")
+def edit(ctx, id_, no_rebuild):
     """Edit a post with given ID."""
 
     tagquery = """SELECT text AS tag FROM tags, tags_ref WHERE
     tags_ref.post_id = ? AND tags.tag_id = tags_ref.tag_id
     ORDER BY tag"""
-    postquery = "SELECT title, content FROM posts WHERE post_id = ?"
-    updatequery = """UPDATE posts SET title = ?, content = ?
+    postquery = "SELECT title, content, filename, hidden FROM posts WHERE post_id = ?"
+    updatequery = """UPDATE posts SET title = ?, content = ?, filename = ?,
+                  summary_end = ?, description = ?, word_count = ?, reading_time = ?
                   WHERE post_id = ?"""
     cur.execute(postquery, (id_,))
     try:
-        title, content = cur.fetchone()
+        title, content, filename, hidden = cur.fetchone()
     except:
         raise click.BadParameter("No posts found.", param=id_, param_hint="ID")
 
@@ -809,96 +2779,711 @@ def edit(ctx, id_):
 
     if new_content is not None:
         title, body, tags = split_input(new_content)
-        cur.execute(updatequery, (title, body, id_))
-        conn.commit()
+        if hidden:
+            # The URL of a published post stays, a draft follows its title
+            filename = postfilename(title, id_)
+        cur.execute(updatequery, (title, body, filename) + postmeta(body) + (id_,))
+        queuerebuild([id_])
         db_tagpost(tags, id_)
-        ctx.invoke(rebuild)
+        if not no_rebuild:
+            ctx.invoke(rebuild)
     else:
         raise click.UsageError("No edits made")
 
 
 @click.command()
 @click.argument('id_', type=click.INT, metavar='ID')
+@click.option('--no-rebuild', is_flag=True,
+              help="Don't rebuild the blog, queue the change for rebuild --pending.")
 @click.pass_context
-def hide(ctx, id_):
+@uses("db")
+def hide(ctx, id_, no_rebuild):
     """Flag a post with given ID as hidden."""
     set_post_hidden(id_, True)
-    ctx.invoke(rebuild)
+    if not no_rebuild:
+        ctx.invoke(rebuild)
 
 
 @click.command()
 @click.argument('id_', type=click.INT, metavar='ID')
+@click.option('--no-rebuild', is_flag=True,
+              help="Don't rebuild the blog, queue the change for rebuild --pending.")
 @click.pass_context
-def unhide(ctx, id_):
+@uses("db")
+def unhide(ctx, id_, no_rebuild):
     """Flag a post with given ID as not hidden."""
     set_post_hidden(id_, False)
-    ctx.invoke(rebuild)
+    if not no_rebuild:
+        ctx.invoke(rebuild)
+
+
+def blogfiles() -> dict:
+    """Get the state of each file in blog_dir, by path relative to it.
+
+    The state of a generated file is its content hash from the build
+    manifest and that of its precompressed siblings the same with their
+    suffix, as they are made from it. Other files, and generated ones
+    without a hash yet, are known by their mtime and size."""
+
+    import os
+
+    root = blog_conf["files"]["blog_dir"]
+    hashes = dict(conn.execute("SELECT path, hash FROM build_manifest "
+                               "WHERE hash IS NOT NULL"))
+    files = {}
+    for top, dirs, names in os.walk(root):
+        dirs.sort()
+        for name in sorted(names):
+            if name.startswith(".challi-"):
+                continue
+            filename = path.join(top, name)
+            relpath = path.relpath(filename, root).replace(os.sep, "/")
+            base, suffix = path.splitext(relpath)
+            if relpath in hashes:
+                files[relpath] = hashes[relpath]
+            elif suffix in compressors and base in hashes:
+                files[relpath] = hashes[base] + suffix
+            else:
+                st = os.stat(filename)
+                files[relpath] = "{}:{}".format(st.st_mtime_ns, st.st_size)
+    return files
+
+
+def copyfile(src: str, dest: str):
+    """Copy a file with its mtime, atomically replacing dest."""
+
+    import os
+    import shutil
+    import tempfile
+
+    dirname = path.dirname(dest)
+    makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".challi-")
+    os.close(fd)
+    try:
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def uploadlocal(dest: str, changed: list, deleted: list, jobs: int):
+    """Copy the changed files to the directory dest in jobs threads and
+    remove the deleted ones, with any directories they leave empty."""
+
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
+    root = blog_conf["files"]["blog_dir"]
+    with ThreadPoolExecutor(jobs) as pool, \
+            click.progressbar(length=len(changed), label="Copying files") as bar:
+        copies = [pool.submit(copyfile, path.join(root, p), path.join(dest, p))
+                  for p in changed]
+        for copy in copies:
+            copy.result()
+            bar.update(1)
+    for p in deleted:
+        target = path.join(dest, p)
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+        try:
+            os.removedirs(path.dirname(target))
+        except OSError:
+            pass
+
+
+def uploadrsync(dest: str, changed: list, deleted: list):
+    """Upload the changed files with one rsync run, which is given their
+    paths and those of the deleted files in a --files-from list. rsync
+    deletes the files missing here on the destination."""
+
+    import shlex
+    import subprocess
+    import tempfile
+
+    options = shlex.split(blog_conf.get("files", "rsync_options", fallback="-az"))
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt") as f:
+        f.writelines(p + "\n" for p in changed + deleted)
+        f.flush()
+        command = ["rsync"] + options + ["--files-from", f.name, "--delete-missing-args",
+                                         blog_conf["files"]["blog_dir"] + "/", dest + "/"]
+        try:
+            result = subprocess.run(command)
+        except OSError as e:
+            raise click.ClickException("Cannot run rsync: {}".format(e))
+    if result.returncode != 0:
+        raise click.ClickException("rsync failed with exit status {}, nothing was "
+                                   "recorded as uploaded".format(result.returncode))
 
 
 @click.command()
-def upload():
+@click.option("--full", is_flag=True,
+              help="Upload every file, not just the ones changed since the last upload.")
+@click.option("--dry-run", "-n", is_flag=True,
+              help="Only list the files that would be uploaded or deleted.")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=8,
+              help="Copy files in this many threads to a local directory (default=8).")
+@uses("db")
+def upload(full, dry_run, jobs):
     """Upload the blog.
 
-    Copies the blog to the configured
-    location using rsync."""
-    if not "rsync_user" in blog_conf["files"] \
-      or blog_conf["files"]["rsync_user"] == "":
-        from pwd import getpwuid
-        from os import getuid
-        blog_conf["files"]["rsync_user"] = getpwuid(getuid()).pw_name
+    Only the files that changed since the last upload to the configured
+    rsync_dest are uploaded, and the files removed from the blog since
+    are deleted there. A destination with a host, like
+    example.com:/var/www/html/blog, is uploaded to with rsync over SSH, a
+    plain directory is copied to directly. What was uploaded is recorded
+    after the upload succeeds."""
+
     if not "rsync_dest" in blog_conf["files"] \
       or blog_conf["files"]["rsync_dest"] == "":
         raise click.UsageError("No 'rsync_dest' specified in config!")
+    if "rsync_command" in blog_conf["files"]:
+        click.echo("Note: rsync_command is no longer used, see rsync_options", err=True)
+    dest = blog_conf["files"]["rsync_dest"]
+    remote = ":" in dest
+    if remote:
+        if not "rsync_user" in blog_conf["files"] \
+          or blog_conf["files"]["rsync_user"] == "":
+            from pwd import getpwuid
+            from os import getuid
+            blog_conf["files"]["rsync_user"] = getpwuid(getuid()).pw_name
+        if "@" not in dest.split(":", 1)[0]:
+            dest = "{}@{}".format(blog_conf["files"]["rsync_user"], dest)
+    else:
+        dest = path.abspath(dest)
+
+    files = blogfiles()
+    uploaded = dict(conn.execute("SELECT path, state FROM uploaded WHERE dest = ?",
+                                 (dest,)))
+    changed = [p for p, state in files.items() if full or uploaded.get(p) != state]
+    deleted = [p for p in uploaded if p not in files]
+    if dry_run:
+        for p in changed:
+            click.echo("upload " + p)
+        for p in deleted:
+            click.echo("delete " + p)
+        return
+    if not changed and not deleted:
+        click.echo("Nothing to upload to {}".format(dest))
+        return
+    click.echo("Uploading {} files and deleting {} at {}".format(
+        len(changed), len(deleted), dest))
+    if remote:
+        uploadrsync(dest, changed, deleted)
+    else:
+        try:
+            uploadlocal(dest, changed, deleted, jobs)
+        except OSError as e:
+            raise click.ClickException("Error uploading blog, nothing was recorded "
+                                       "as uploaded:\n{}".format(e))
+    with conn:
+        conn.executemany("DELETE FROM uploaded WHERE dest = ? AND path = ?",
+                         ((dest, p) for p in deleted))
+        conn.executemany("INSERT OR REPLACE INTO uploaded (dest, path, state) "
+                         "VALUES (?, ?, ?)", ((dest, p, files[p]) for p in changed))
+    click.echo("Uploaded {} files, deleted {}".format(len(changed), len(deleted)))
+
+
+def readpost(filename: str, tags_header: str) -> Tuple:
+    """Read a post file to import. Returns the title, body, publish date,
+    list of tags and PostMeta of the post. The publish date is the file's
+    modification time."""
+
+    pd = datetime.fromtimestamp(path.getmtime(filename), timezone.utc). \
+        strftime("%Y-%m-%d %H:%M:%S")
+    with open(filename, encoding="utf-8") as f:
+        title, body, tags = split_input(f.read(), tags_header)
+    return title, body, pd, tags, postmeta(body)
+
+
+def importbatch(posts, tag_ids: dict) -> int:
+    """Insert a batch of imported posts in one transaction.
+
+    posts is an iterable of (filename, readpost(filename)).
+    tag_ids maps the text of each existing tag to its ID and is updated with
+    the tags created. Returns the number of posts inserted."""
+
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        # The post IDs are handed out here so that the posts can be inserted
+        # with executemany and still be referred to by the tags.
+        next_id = conn.execute(
+            "SELECT max(coalesce(max(post_id), 0), coalesce((SELECT seq FROM "
+            "sqlite_sequence WHERE name = 'posts'), 0)) + 1 FROM posts").fetchone()[0]
+        rows, refs, files = [], [], []
+        for post_id, (filename, (title, body, pd, tags, meta)) in enumerate(posts, next_id):
+            rows.append((post_id, title, body, pd,
+                         path.splitext(path.basename(filename))[0] + ".html") + meta)
+            files.append((filename, post_id))
+            for tag in dict.fromkeys(tags):
+                if not tag:
+                    continue
+                if tag not in tag_ids:
+                    tag_ids[tag] = conn.execute("INSERT INTO tags (text) VALUES (?)",
+                                                (tag,)).lastrowid
+                refs.append((tag_ids[tag], post_id))
+        conn.executemany("INSERT INTO posts (post_id, title, content, publish_date, "
+                         "filename, hidden, summary_end, description, word_count, "
+                         "reading_time) VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?, ?)", rows)
+        conn.executemany("INSERT INTO tags_ref (tag_id, post_id) VALUES (?, ?)", refs)
+        conn.executemany("INSERT INTO imported_files (path, post_id) VALUES (?, ?)", files)
+        queuerebuild(post_id for filename, post_id in files)
+    return len(rows)
+
+
+def writeredirects():
+    """Append redirects from the old URLs of the imported posts to their new
+    ones to .htaccess in the blog directory. Each post gets its redirect once,
+    even if the import was interrupted."""
+
+    rows = conn.execute("SELECT posts.filename, posts.publish_date FROM imported_files "
+                        "JOIN posts USING (post_id) WHERE imported_files.redirected = 0 "
+                        "ORDER BY imported_files.post_id")
+    lines = ["Redirect /{} /{}\n".format(fn, geturi(fn, pd)) for fn, pd in rows]
+    if lines:
+        makedirs(blog_conf["files"]["blog_dir"], exist_ok=True)
+        with open(path.join(blog_conf["files"]["blog_dir"], ".htaccess"), "a",
+                  encoding="utf-8") as htaccess:
+            htaccess.writelines(lines)
+    with conn:
+        conn.execute("UPDATE imported_files SET redirected = 1 WHERE redirected = 0")
+
+
+@click.command(name="import")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("--tags-header",
+              help="Beginning of the line listing the tags of a post "
+                   "(default=the configured tags_line_header).")
+@click.option("--batch", type=click.IntRange(min=1), default=1000,
+              help="Number of posts to insert per transaction (default=1000).")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=8,
+              help="Read files in this many threads (default=8).")
+@click.option("--no-rebuild", is_flag=True,
+              help="Don't rebuild the blog, queue the posts for rebuild --pending.")
+@click.pass_context
+@uses("db")
+def import_posts(ctx, directory, tags_header, batch, jobs, no_rebuild):
+    """Import posts from a Bashblog directory.
+
+    Each Markdown file becomes a published post dated by the file's
+    modification time. Files imported before are skipped, so an interrupted
+    import continues where it left off when run again."""
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+
+    imported = set(r[0] for r in conn.execute("SELECT path FROM imported_files"))
+    files = []
+    for top, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            filename = path.abspath(path.join(top, name))
+            if path.splitext(name)[1].lower() in (".md", ".markdown") \
+                    and filename not in imported:
+                files.append(filename)
+    batches = [files[i:i + batch] for i in range(0, len(files), batch)]
+    tag_ids = dict(conn.execute("SELECT text, tag_id FROM tags"))
+    count = 0
+
+    with ThreadPoolExecutor(jobs) as pool, \
+            click.progressbar(length=len(files), label="Importing posts") as bar:
+        read = partial(readpost, tags_header=tags_header)
+        pending = pool.map(read, batches[0]) if batches else None
+        for i, names in enumerate(batches):
+            posts = list(pending)
+            # Read the next batch while this one is inserted
+            if i + 1 < len(batches):
+                pending = pool.map(read, batches[i + 1])
+            count += importbatch(zip(names, posts), tag_ids)
+            bar.update(len(names))
+    writeredirects()
+    click.echo("Imported {} posts, skipped {} imported before".format(
+        count, len(imported)))
+    if count and not no_rebuild:
+        ctx.invoke(rebuild)
+
+
+@click.command()
+@click.argument("query", nargs=-1, required=True)
+@click.option("--limit", "-n", type=click.IntRange(min=1), default=20,
+              help="Show at most this many posts (default=20).")
+@click.option("--hidden", is_flag=True, help="Also search hidden posts.")
+@uses("db")
+def search(query, limit, hidden):
+    """Search posts, best matches first.
+
+    QUERY is in the SQLite FTS5 query syntax: words, "phrases", prefixes
+    like blog*, AND, OR, NOT and title: or content: to search one column.
+    Words in the title count ten times as much as in the content."""
+
+    rowstr = "{:>6} | {:>16} | {:>6} | {}"
     try:
-        system(blog_conf["files"]["rsync_command"])
-    except Exception as e:
-        raise click.Abort("Error uploading blog:\n%s" % e)
+        rows = conn.execute(
+            "SELECT posts.post_id, posts.publish_date, posts.hidden, posts.title, "
+            "snippet(posts_fts, 1, '[', ']', '...', 12) AS snippet "
+            "FROM posts_fts JOIN posts ON posts.post_id = posts_fts.rowid "
+            "WHERE posts_fts MATCH ? AND (? OR posts.hidden = 0) "
+            "ORDER BY bm25(posts_fts, 10.0, 1.0) LIMIT ?",
+            (" ".join(query), hidden, limit)).fetchall()
+    except sqlite3.OperationalError as e:
+        raise click.BadParameter(str(e), param_hint="QUERY")
+    if not rows:
+        raise click.ClickException("No posts found.")
+    click.echo(rowstr.format("ID", "Date", "Hidden", "Title"))
+    for row in rows:
+        click.echo(rowstr.format(row["post_id"], row["publish_date"][:16],
+                                 "✔" if row["hidden"] else " ", row["title"]))
+        click.echo("{:>6} | {:>16} | {:>6} | {}".format(
+            "", "", "", " ".join(row["snippet"].split())))
+
+
+@click.command()
+@click.option("--bind", "-b", default="127.0.0.1",
+              help="Address to listen on (default=127.0.0.1).")
+@click.option("--port", "-p", type=click.IntRange(0, 65535), default=8000,
+              help="Port to listen on (default=8000).")
+@click.option("--cache", type=click.IntRange(min=0), default=256,
+              help="Number of pages to keep in memory (default=256).")
+@uses("db", "templates")
+def serve(bind, port, cache):
+    """Serve the blog locally for previewing it.
+
+    Pages are made from the database when they are asked for and nothing
+    is written to blog_dir. Made pages are kept in memory until the
+    database, the config file or the header or footer file changes. Other
+    files, like images, are served from blog_dir, and the CSS files also
+    from the directory of the config file."""
+    import mimetypes
+    import os
+    import time
+    from functools import lru_cache
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import unquote, urlsplit
+
+    global full_build
+    full_build = True
+    page = lru_cache(maxsize=cache)(makepage)
+    mimetypes.add_type("application/rss+xml", ".rss")
+    mimetypes.add_type("application/atom+xml", ".atom")
+
+    def stat(filename):
+        try:
+            st = os.stat(filename)
+            return st.st_mtime_ns, st.st_size
+        except (OSError, TypeError):
+            return None
+
+    def watched():
+        return (stat(db_file), stat(db_file + "-wal"), stat(config_file),
+                stat(blog_conf.get("files", "header_file", fallback=None)),
+                stat(blog_conf.get("files", "footer_file", fallback=None)))
+
+    def staticfile(relpath):
+        relpath = path.normpath(relpath)
+        if relpath.startswith("..") or path.isabs(relpath):
+            return None
+        filenames = [path.join(blog_conf["files"]["blog_dir"], relpath)]
+        # The CSS files, but nothing else, may also be next to the config
+        if relpath in (c.strip() for c in blog_conf["files"]["css_include"].split(",")):
+            filenames.append(path.join(path.dirname(config_file), relpath))
+        for filename in filenames:
+            if path.isfile(filename):
+                with open(filename, "rb") as f:
+                    return f.read()
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.respond(body=True)
+
+        def do_HEAD(self):
+            self.respond(body=False)
+
+        def respond(self, body):
+            start = time.perf_counter()
+            relpath = unquote(urlsplit(self.path).path).lstrip("/")
+            if relpath == "":
+                relpath = blog_conf.get("files", "index_file", fallback="index.html")
+            elif relpath.endswith("/"):
+                relpath += "index.html"
+            refresh()
+            hits = page.cache_info().hits
+            data = page(relpath)
+            how = "cached" if page.cache_info().hits > hits else "made"
+            if data is None:
+                data, how = staticfile(relpath), "static"
+            if data is None:
+                self.send_error(404)
+                return
+            ctype = mimetypes.guess_type(relpath)[0] or "application/octet-stream"
+            if ctype.startswith("text/") or ctype.endswith(("xml", "json", "javascript")):
+                ctype += "; charset=utf-8"
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            if body:
+                self.wfile.write(data)
+            self.log_message("%s %s in %.1f ms", relpath, how,
+                             (time.perf_counter() - start) * 1000)
+
+    server = HTTPServer((bind, port), Handler)
+    url = "http://{}:{}".format(*server.server_address[:2])
+    state = [watched()]
+
+    def refresh():
+        now = watched()
+        if now != state[0]:
+            state[0] = now
+            page.cache_clear()
+            index_keys.clear()
+            loadconfig()
+            blog_conf["blog"]["url"] = url
+            loadtemplates()
+    blog_conf["blog"]["url"] = url
+    loadtemplates()
+
+    click.echo("Serving the blog at {}/ (Ctrl-C to quit)".format(url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@click.group(name="db")
+def db_group():
+    """Database maintenance."""
+
+
+@db_group.command()
+@uses("db")
+def optimize():
+    """Optimize the database.
+
+    Updates the statistics the query planner uses (ANALYZE, PRAGMA optimize)
+    and rebuilds the database file to reclaim free space (VACUUM)."""
+    size = path.getsize(db_file)
+    click.echo("Analyzing ...")
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
+    click.echo("Vacuuming ...")
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    click.echo("Database size {} -> {} bytes".format(size, path.getsize(db_file)))
 
 
 @click.command()
 @click.argument('id_', type=click.INT, metavar='ID')
+@click.option('--no-rebuild', is_flag=True,
+              help="Don't rebuild the blog, queue the change for rebuild --pending.")
 @click.pass_context
-def rm(ctx, id_):
-    """Remove a post with given ID. The post is deleted from both
-    the directory tree and the database.
+@uses("db")
+def rm(ctx, id_, no_rebuild):
+    """Remove a post with given ID. The post is deleted from the database,
+    and its page from the directory tree by the rebuild.
 
     Remember that you can also hide posts. This retains the data in
     the database, in case you want to use it again later.
     """
-    import os
-
-    try:
-        pd, fn = next(cur.execute(
-            "SELECT publish_date, filename FROM posts WHERE post_id = ?", (id_,)))
-    except:
-        raise click.BadParameter("No posts found.", param=id_, param_hint="ID")
-    else:
-        # Remove the file
-        os.remove(path.join(blog_conf["files"]["blog_dir"], geturi(fn, pd)))
-        # Attempt to prune the directory tree the file was in
-        try:
-            os.removedirs(path.join(blog_conf["files"]["blog_dir"],
-                                    path.dirname(geturi(fn, pd))))
-        except OSError:
-            pass
-        cur.execute("DELETE FROM posts WHERE post_id = ?", (id_,))
-        conn.commit()
-        click.echo("Deleted post with id {}".format(id_))
+    cur.execute("DELETE FROM posts WHERE post_id = ?", (id_,))
+    if cur.rowcount == 0:
+        raise click.BadParameter("No posts found.", param_hint="ID")
+    queuerebuild([id_])
+    conn.commit()
+    click.echo("Deleted post with id {}".format(id_))
+    if not no_rebuild:
         ctx.invoke(rebuild)
 
 
 @click.command()
-def rebuild():
-    """Rebuild all posts, tags and indexes."""
+@click.option('--debounce', type=click.FloatRange(min=0), default=2.0,
+              help="Rebuild once no changes have been queued for this many seconds "
+                   "(default=2).")
+@click.option('--max-delay', type=click.FloatRange(min=0), default=30.0,
+              help="Rebuild at the latest this many seconds after the first queued "
+                   "change (default=30).")
+@click.option('--interval', type=click.FloatRange(min=0.1), default=1.0,
+              help="Check the queue this often, in seconds (default=1).")
+@click.option('--jobs', '-j', type=click.IntRange(min=0), default=1,
+              help="Render posts in this many processes (0 = one per CPU).")
+@click.pass_context
+@uses("db", "templates")
+def worker(ctx, debounce, max_delay, interval, jobs):
+    """Rebuild the blog when changes are queued.
+
+    Runs until interrupted, rebuilding after the commands run with
+    --no-rebuild. A burst of changes is rebuilt once, after no change has
+    been queued for --debounce seconds, or --max-delay seconds after the
+    first one if they keep coming. The config is read again for each
+    rebuild."""
+    from time import sleep
+
+    click.echo("Waiting for changes (Ctrl-C to quit)")
+    try:
+        while True:
+            queued = rebuildqueue()
+            now = time()
+            if queued and (now - max(q[1] for q in queued) >= debounce or
+                           now - min(q[1] for q in queued) >= max_delay):
+                click.echo("Rebuilding {} changed posts".format(len(queued)))
+                loadconfig()
+                loadtemplates()
+                ctx.invoke(rebuild, jobs=jobs, pending=True)
+            else:
+                sleep(interval)
+    except KeyboardInterrupt:
+        pass
 
-    writeposts()
-    makeindex()
-    makefullidx()
-    maketagpages()
-    maketagindex()
+
+@click.command()
+@click.option('--all', 'all_', is_flag=True,
+              help="Index every post, not just the ones without stored metadata.")
+@uses("db")
+def reindex(all_):
+    """Store the metadata derived from the content of posts.
+
+    The summary break, description, word count and reading time of a post
+    are stored when it is written. This fills them in for posts written
+    by older versions or changed in the database directly."""
+
+    rows = conn.execute("SELECT post_id, content FROM posts" +
+                        ("" if all_ else " WHERE description IS NULL")).fetchall()
+    with click.progressbar(rows, label="Indexing posts") as bar:
+        updates = [postmeta(row["content"] or "") + (row["post_id"],) for row in bar]
+    with conn:
+        conn.executemany("UPDATE posts SET summary_end = ?, description = ?, "
+                         "word_count = ?, reading_time = ? WHERE post_id = ?", updates)
+    click.echo("Indexed {} posts".format(len(updates)))
 
 
-for func in post, list_posts, edit, hide, unhide, upload, rm, rebuild, init:
+@click.command()
+@click.option('--full', is_flag=True,
+              help="Regenerate every file, not just the ones whose inputs changed.")
+@click.option('--jobs', '-j', type=click.IntRange(min=0), default=1,
+              help="Render posts in this many processes (0 = one per CPU).")
+@click.option('--stats', 'show_stats', is_flag=True,
+              help="Show the time, SQL statements, files and renders of each stage.")
+@click.option('--stats-json', type=click.File('w'),
+              help="Write the stats as JSON to this file ('-' for standard output).")
+@click.option('--profile', type=click.Path(dir_okay=False, writable=True),
+              help="Profile the build with cProfile and write the pstats to this file.")
+@click.option('--pending', is_flag=True,
+              help="Only rebuild if changes were queued with --no-rebuild.")
+def rebuild(full, jobs, show_stats, stats_json, profile, pending):
+    """Rebuild all posts, tags, indexes and feeds.
+
+    Only files whose inputs changed since the last build are regenerated,
+    unless --full is given. The changes queued by commands run with
+    --no-rebuild are cleared."""
+
+    if stats_json is not None and stats_json.name == "<stdout>":
+        import sys
+
+        # Keep the JSON on standard output apart from everything else
+        with redirect_stdout(sys.stderr):
+            rebuildblog(full, jobs, show_stats, stats_json, profile, pending)
+    else:
+        rebuildblog(full, jobs, show_stats, stats_json, profile, pending)
+
+
+@uses("db", "templates")
+def rebuildblog(full, jobs, show_stats, stats_json, profile, pending):
+    """Rebuild the blog, see rebuild."""
+
+    global full_build, output, stats
+    queued = rebuildqueue()
+    if pending and not queued:
+        click.echo("No queued changes")
+        return
+    full_build = full
+    output = Output(blog_conf["files"]["blog_dir"])
+    if jobs == 0:
+        from os import cpu_count
+        jobs = cpu_count() or 1
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    suffixes = precompressed()
+    stats = Stats() if show_stats or stats_json else None
+    start = Stats.now()
+    for k in render_counts:
+        render_counts[k] = 0
+    with stage("manifest"):
+        loadmanifest()
+    sinks = [PostPages(), IndexPages(), ArchivePages(), TagPages(),
+             TagIndexPage(), Feeds()]
+    if searchdir():
+        sinks.append(SearchIndex())
+    build(sinks, jobs=jobs)
+    with stage("render cache"):
+        saverendercache()
+    with stage("manifest"):
+        savemanifest()
+    # Changes queued again during the build stay queued
+    with conn:
+        conn.executemany("DELETE FROM rebuild_queue WHERE post_id = ? AND queued_at = ?",
+                         queued)
+    with stage("precompress"):
+        compressed, compressed_bytes = precompress(suffixes, jobs)
+    if profile:
+        profiler.disable()
+        profiler.dump_stats(profile)
+    end = Stats.now()
+    click.echo("{} files written, {} unchanged, {} up to date, {} removed, "
+               "{} SQL statements{}".format(output.written, output.unchanged,
+                                            len(built) - len(regenerated),
+                                            output.deleted,
+                                            end[2] - start[2],
+                                            ", {} files compressed".format(compressed)
+                                            if compressed else ""))
+    if stats is None:
+        return
+    lookups = render_counts["memory_hits"] + render_counts["db_hits"] + \
+        render_counts["misses"]
+    report = {
+        "full": full_build,
+        "jobs": jobs,
+        "total": {"wall": round(end[0] - start[0], 6), "cpu": round(end[1] - start[1], 6),
+                  "sql_statements": end[2] - start[2],
+                  "sql_time": round(end[3] - start[3], 6)},
+        "stages": stats.asdict(),
+        "files": {"written": output.written, "bytes_written": output.bytes,
+                  "unchanged": output.unchanged, "up_to_date": len(built) - len(regenerated),
+                  "removed": output.deleted, "compressed": compressed,
+                  "bytes_compressed": compressed_bytes},
+        "render": dict(render_counts, hit_rate=round(
+            (lookups - render_counts["misses"]) / lookups, 4) if lookups else None),
+    }
+    stats = None
+    if stats_json:
+        import json
+        json.dump(report, stats_json, indent=2)
+        stats_json.write("\n")
+    if show_stats:
+        rowstr = "{:<14} {:>9} {:>9} {:>8} {:>9}"
+        click.echo(rowstr.format("Stage", "Wall s", "CPU s", "SQL", "SQL s"))
+        for name, s in list(report["stages"].items()) + [("total", report["total"])]:
+            click.echo(rowstr.format(name, "{:.3f}".format(s["wall"]),
+                                     "{:.3f}".format(s["cpu"]), s["sql_statements"],
+                                     "{:.3f}".format(s["sql_time"])))
+        click.echo("{} bytes written".format(output.bytes))
+        r = report["render"]
+        click.echo("{} posts rendered, render cache: {} hits in memory, {} in the "
+                   "database, {} misses{}".format(
+                       r["rendered"], r["memory_hits"], r["db_hits"], r["misses"],
+                       "" if r["hit_rate"] is None
+                       else " ({:.1%} hit rate)".format(r["hit_rate"])))
+
+
+for func in post, list_posts, edit, hide, unhide, upload, import_posts, search, serve, \
+            rm, rebuild, reindex, worker, init, db_group:
     cli.add_command(func)
 
 
@@ -1,3 +1,5 @@
+-- Current schema, i.e. the initial schema in challi.py's init() with all
+-- of its migrations applied
 BEGIN TRANSACTION;
 -- Relation table: tag <-> post
 CREATE TABLE `tags_ref` (
@@ -21,7 +23,16 @@ CREATE TABLE "posts" (
 	-- ISO-8601 timestamp string, UTC
 	`publish_date`	TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
 	`hidden`	INTEGER NOT NULL DEFAULT 1,
-	`filename`	TEXT NOT NULL
+	`filename`	TEXT NOT NULL,
+	-- Derived from the content when the post is written, NULL until
+	-- `challi reindex` for older posts
+	-- Offset of the summary break in content, NULL if there is none
+	`summary_end`	INTEGER,
+	-- Plain text description
+	`description`	TEXT,
+	`word_count`	INTEGER,
+	-- Estimated reading time in minutes
+	`reading_time`	INTEGER
 );
 -- Authors
 CREATE TABLE "authors" (
@@ -39,7 +50,78 @@ CREATE TABLE `authors_ref` (
 	FOREIGN KEY(`author_id`) REFERENCES authors("author_id"),
 	FOREIGN KEY(`post_id`) REFERENCES posts("post_id") ON DELETE CASCADE
 );
-CREATE INDEX `post_pub_date` ON `posts` (`publish_date` DESC);
+-- Input digest of each generated file, relative to blog_dir
+CREATE TABLE `build_manifest` (
+	`path`	TEXT NOT NULL PRIMARY KEY,
+	`digest`	TEXT NOT NULL,
+	-- SHA-1 of the file's content, NULL if not known yet
+	`hash`	TEXT
+);
+-- State of each file uploaded to a destination: its content hash, or
+-- mtime:size for files not in the build manifest
+CREATE TABLE `uploaded` (
+	`dest`	TEXT NOT NULL,
+	`path`	TEXT NOT NULL,
+	`state`	TEXT NOT NULL,
+	PRIMARY KEY (`dest`, `path`)
+) WITHOUT ROWID;
+-- Rendered Markdown of each post, with a hash of the content and render
+-- settings it was rendered from
+CREATE TABLE `render_cache` (
+	`post_id`	INTEGER NOT NULL PRIMARY KEY,
+	`hash`	TEXT NOT NULL,
+	`html`	TEXT NOT NULL,
+	`summary`	TEXT NOT NULL,
+	`is_summary`	INTEGER NOT NULL,
+	`description`	TEXT NOT NULL,
+	FOREIGN KEY(`post_id`) REFERENCES posts("post_id") ON DELETE CASCADE
+);
+-- Posts changed since the last build, queued by the commands run with
+-- --no-rebuild. queued_at is a Unix timestamp.
+CREATE TABLE `rebuild_queue` (
+	`post_id`	INTEGER NOT NULL PRIMARY KEY,
+	`queued_at`	REAL NOT NULL
+);
+-- Posts in the static search index as of the last build: a digest of
+-- their inputs and the prefixes of their words, space separated
+CREATE TABLE `search_posts` (
+	`post_id`	INTEGER NOT NULL PRIMARY KEY,
+	`digest`	TEXT NOT NULL,
+	`prefixes`	TEXT NOT NULL
+);
+-- Files imported with `challi import`
+CREATE TABLE `imported_files` (
+	`path`	TEXT NOT NULL PRIMARY KEY,
+	`post_id`	INTEGER NOT NULL,
+	`redirected`	INTEGER NOT NULL DEFAULT 0
+);
+-- Full-text index of the posts, kept in sync with them by the triggers below
+CREATE VIRTUAL TABLE `posts_fts` USING fts5(
+	title, content, content='posts', content_rowid='post_id',
+	tokenize='unicode61 remove_diacritics 2');
+-- Words of the full-text index by post, for the static search index
+CREATE VIRTUAL TABLE `posts_fts_words` USING fts5vocab(posts_fts, instance);
+CREATE TRIGGER `posts_fts_insert` AFTER INSERT ON `posts` BEGIN
+	INSERT INTO posts_fts (rowid, title, content)
+		VALUES (new.post_id, new.title, new.content);
+END;
+CREATE TRIGGER `posts_fts_delete` AFTER DELETE ON `posts` BEGIN
+	INSERT INTO posts_fts (posts_fts, rowid, title, content)
+		VALUES ('delete', old.post_id, old.title, old.content);
+END;
+CREATE TRIGGER `posts_fts_update` AFTER UPDATE OF title, content ON `posts` BEGIN
+	INSERT INTO posts_fts (posts_fts, rowid, title, content)
+		VALUES ('delete', old.post_id, old.title, old.content);
+	INSERT INTO posts_fts (rowid, title, content)
+		VALUES (new.post_id, new.title, new.content);
+END;
+CREATE INDEX `post_pub_date` ON `posts` (`publish_date` DESC, `post_id` DESC);
+CREATE INDEX `post_title` ON `posts` (`title`);
+-- Published posts, for the generators
+CREATE INDEX `post_visible_pub_date` ON `posts` (`publish_date` DESC, `post_id` DESC) WHERE `hidden` = 0;
 CREATE INDEX `author_name` ON `authors` (`name` ASC);
-CREATE UNIQUE INDEX `tag_ref_i` ON `tags_ref`(`tag_id`, `post_id`);
+CREATE INDEX `tags_ref_post` ON `tags_ref` (`post_id`, `tag_id`);
+CREATE INDEX `authors_ref_post` ON `authors_ref` (`post_id`);
+CREATE INDEX `authors_ref_author` ON `authors_ref` (`author_id`);
+PRAGMA user_version = 10;
 COMMIT;